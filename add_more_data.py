@@ -7,6 +7,8 @@ reference: https://github.com/JarveeLee/SynthText_Chinese_version/blob/master/ad
 import numpy as np
 import h5py
 import os, sys
+import traceback
+import multiprocessing as mp
 import wget, tarfile
 from common import *
 import os.path as osp
@@ -73,52 +75,120 @@ def download_preproc():
       sys.exit(-1)
 
 
+# per-process state of the decoder workers:
+_worker = {}
+
+def init_worker(more_depth_path,more_seg_path):
+  _worker['depth_db'] = h5py.File(more_depth_path,'r')
+  _worker['seg_db'] = h5py.File(more_seg_path,'r')
+
+def decode_worker(args):
+  """
+  Decode the image and read its depth and segmentation.
+  Returns (imname, data, missing): DATA is a dict of the arrays and
+  attributes to store, or None if the depth and/or the segmentation
+  is missing (listed in MISSING) or the image could not be read.
+  """
+  imname,full_path = args
+  depth_db,seg_db = _worker['depth_db'],_worker['seg_db']
+  # not every image has a corresponding depth and segmentation:
+  missing = [k for k,present in (('depth',imname in depth_db),('seg',imname in seg_db['mask'])) if not present]
+  if missing:
+    return imname,None,missing
+  try:
+    seg = seg_db['mask'][imname]
+    data = {'image': np.array(Image.open(full_path)),
+            'depth': depth_db[imname][:],
+            'seg': seg[:],
+            'area': seg.attrs['area'],
+            'label': seg.attrs['label']}
+  except:
+    traceback.print_exc()
+    return imname,None,['image']
+  return imname,data,[]
+
+def write_scene(db,imname,data):
+  db['image'].create_dataset(imname,data=data['image'])
+  db['depth'].create_dataset(imname,data=data['depth'])
+  db['seg'].create_dataset(imname,data=data['seg'])
+  db['seg'][imname].attrs['area'] = data['area']
+  db['seg'][imname].attrs['label'] = data['label']
+
+
 # add/merge pre-processed data files into dset_8000.h5 
-def add_more_data_into_dset(DB_FNAME,more_img_file_path,more_depth_path,more_seg_path):
+def add_more_data_into_dset(DB_FNAME,more_img_file_path,more_depth_path,more_seg_path,nworkers=1,restart=False):
+  """
+  Merges the images, depth and segmentation into DB_FNAME: a pool of
+  NWORKERS processes decodes the images and reads the depth/seg, this
+  process is the single writer.
+  The merge is resumable: the names of the completely written images are
+  appended to the manifest DB_FNAME.done, and a re-run only merges the
+  others (unless RESTART). The images without depth or seg are skipped
+  and listed in DB_FNAME.missing.txt.
+  """
   print (colorize(Color.GREEN,'adding data into h5 file..',bold=True))
-  # open files (a:append, r:read, w:write/overwrite)
-  db=h5py.File(DB_FNAME,'w')
-  depth_db=h5py.File(more_depth_path, 'r')
-  seg_db=h5py.File(more_seg_path, 'r')
-  db.create_group('image')
-  db.create_group('depth')
-  db.create_group('seg')
-
-  #print(list(depth_db.keys()))
-  #print(list(seg_db.keys()))
-
-  for imname in os.listdir(more_img_file_path):
-    if imname.endswith('.jpg'):
-      full_path=more_img_file_path + '\\' + imname
-      print (full_path,imname)
-      print('image size: %d bytes'%os.path.getsize(full_path))
-
-      img_np = np.array(Image.open(full_path))
-      
-      db['image'].create_dataset(imname,data=img_np)
-
-      # specify exceptions, because not every image has a corresponding depth and segmentation 
-      try:
-        db['depth'].create_dataset(imname,data=depth_db[imname])
-      except KeyError:
-        print(imname)
-        continue 
-
-      try:
-        db['seg'].create_dataset(imname,data=seg_db['mask'][imname])
-        db['seg'][imname].attrs['area']=seg_db['mask'][imname].attrs['area']
-        db['seg'][imname].attrs['label']=seg_db['mask'][imname].attrs['label']
-      except KeyError:
-        print(imname)
+  manifest_fname = DB_FNAME+'.done'
+  if restart or not osp.exists(DB_FNAME):
+    if osp.exists(manifest_fname):
+      os.remove(manifest_fname)
+  done = set()
+  if osp.exists(manifest_fname):
+    with open(manifest_fname,'r') as f:
+      done = set(l.strip() for l in f if l.strip())
+    print (colorize(Color.GREEN,'resuming: %d images are already merged'%len(done),bold=True))
+
+  # open the output (a:append, w:write/overwrite):
+  db = h5py.File(DB_FNAME,'a' if done else 'w')
+  for grp in ('image','depth','seg'):
+    if grp not in db:
+      db.create_group(grp)
+    # remove the partially written images of an interrupted run:
+    for imname in [n for n in db[grp].keys() if n not in done]:
+      del db[grp][imname]
+
+  imnames = sorted(n for n in os.listdir(more_img_file_path) if n.endswith('.jpg') and n not in done)
+  todo = [(n,osp.join(more_img_file_path,n)) for n in imnames]
+  print (colorize(Color.GREEN,'merging %d images with %d workers'%(len(todo),nworkers),bold=True))
+
+  missing = []
+  manifest = open(manifest_fname,'a')
+  pool = mp.Pool(nworkers,initializer=init_worker,initargs=(more_depth_path,more_seg_path))
+  try:
+    for i,(imname,data,miss) in enumerate(pool.imap_unordered(decode_worker,todo,chunksize=4)):
+      if data is None:
+        print (colorize(Color.RED,'%s : missing %s'%(imname,', '.join(miss))))
+        missing.append((imname,miss))
         continue
+      write_scene(db,imname,data)
+      db.flush()
+      manifest.write(imname+'\n')
+      manifest.flush()
+      print ('%d of %d : %s'%(i,len(todo)-1,imname))
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
+    manifest.close()
+    db.close()
+
+  with open(DB_FNAME+'.missing.txt','w') as f:
+    for imname,miss in sorted(missing):
+      f.write('%s %s\n'%(imname,','.join(miss)))
   print (colorize(Color.GREEN,'\t-> done',bold=True))
   print (colorize(Color.GREEN,'Stored the data in: '+DB_FNAME, bold=True))
-
-  db.close()
-  depth_db.close()
-  seg_db.close()
+  if missing:
+    nd = sum('depth' in m for _,m in missing)
+    ns = sum('seg' in m for _,m in missing)
+    ni = sum('image' in m for _,m in missing)
+    print (colorize(Color.RED,'skipped %d images (no depth: %d, no seg: %d, unreadable: %d), see %s'%(
+      len(missing),nd,ns,ni,DB_FNAME+'.missing.txt'),bold=True))
 
 
 if __name__ == '__main__':
+  import argparse
+  parser = argparse.ArgumentParser(description='Merge the pre-processed images, depth and segmentation into one h5 file')
+  parser.add_argument('--workers',type=int,dest='workers',default=mp.cpu_count(),help='number of decoder processes')
+  parser.add_argument('--restart',action='store_true',dest='restart',default=False,help='start over instead of resuming an interrupted merge')
+  args = parser.parse_args()
   download_preproc()
-  add_more_data_into_dset(DB_FNAME,more_img_file_path,more_depth_path,more_seg_path)
\ No newline at end of file
+  add_more_data_into_dset(DB_FNAME,more_img_file_path,more_depth_path,more_seg_path,args.workers,args.restart)
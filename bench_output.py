@@ -0,0 +1,75 @@
+"""
+Benchmark of the output image layouts (see image_store.py): for every
+layout, writes rendered-like images with gen_more.ResultWriter (encoding in
+its thread pool) to a temporary h5 file and reads them back.
+
+The images are 600x800 crops of samples.png (synthetic text on natural
+scenes), so that they compress like the real output.
+Reports the bytes per image, the write throughput and the read-back
+throughput, and the max. pixel error of the read-back images.
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import os.path as osp
+import tempfile
+import time
+import numpy as np
+import h5py
+from PIL import Image
+import gen_more
+from image_store import COMPRESSIONS, read_image
+
+
+def sample_images(n, H=600, W=800, fname='samples.png'):
+    rng = np.random.RandomState(0)
+    im = np.array(Image.open(fname).convert('RGB'))
+    if im.shape[0] < H or im.shape[1] < W:
+        s = max(H/im.shape[0], W/im.shape[1])
+        im = np.array(Image.fromarray(im).resize((int(np.ceil(s*im.shape[1])),int(np.ceil(s*im.shape[0])))))
+    ims = []
+    for _ in range(n):
+        y,x = rng.randint(0,im.shape[0]-H+1), rng.randint(0,im.shape[1]-W+1)
+        ims.append(np.ascontiguousarray(im[y:y+H,x:x+W]))
+    return ims
+
+def bench(compression, ims, nthreads, fname):
+    idict = {'txt':['Beispiel'], 'charBB':np.zeros((2,4,8)), 'wordBB':np.zeros((2,4,1))}
+    db = h5py.File(fname,'w')
+    db.create_group('/data')
+    t = time.time()
+    with contextlib.redirect_stdout(io.StringIO()): # per-instance print of the writer
+        writer = gen_more.ResultWriter(db,compression=compression,nthreads=nthreads)
+        for i,im in enumerate(ims):
+            writer.put('img_%d'%i, dict(idict,img=im))
+        writer.close()
+    db.close()
+    t_write = time.time()-t
+    nbytes = osp.getsize(fname)
+
+    db = h5py.File(fname,'r')
+    t = time.time()
+    err = 0
+    for i,im in enumerate(ims):
+        err = max(err, np.abs(read_image(db['data']['img_%d'%i]).astype('int32')-im).max())
+    t_read = time.time()-t
+    db.close()
+    os.remove(fname)
+    return nbytes/len(ims), len(ims)/t_write, len(ims)/t_read, err
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the output image layouts')
+    parser.add_argument('--n',type=int,default=64,help='number of images')
+    parser.add_argument('--threads',type=int,default=4,help='number of encoding threads')
+    args = parser.parse_args()
+
+    ims = sample_images(args.n)
+    fname = osp.join(tempfile.gettempdir(),'bench_output.h5')
+    print('%8s %12s %8s %14s %13s %8s'%('layout','KB / image','ratio','write [img/s]','read [img/s]','max err'))
+    raw = ims[0].nbytes
+    for c in COMPRESSIONS:
+        b,w,r,e = bench(c, ims, args.threads, fname)
+        print('%8s %12.1f %7.2fx %14.1f %13.1f %8d'%(c,b/1024,raw/b,w,r,e))
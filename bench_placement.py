@@ -0,0 +1,75 @@
+"""
+Benchmark of the collision search used to place text in a region
+(RenderFont.place_text): compares the exact FFT search with the
+summed-area table (SAT) search, with and without the FFT fallback.
+
+Synthetic regions are filled with synthetic text rasters in the same
+way RendererV3 re-uses a region: after every successful placement the
+dilated text is added to the collision mask.
+Reports the time per search and the acceptance rate.
+"""
+
+import time
+import numpy as np
+import cv2
+from text_utils import safe_locs_fft, safe_locs_sat
+
+
+def random_region(rng, H=300, W=500):
+    """
+    Placement mask of a random convex region: 0 inside (safe), 255 outside.
+    """
+    mask = 255*np.ones((H,W),'uint8')
+    pts = np.c_[rng.randint(0,W,12), rng.randint(0,H,12)].astype('int32')
+    cv2.fillConvexPoly(mask, cv2.convexHull(pts), 0)
+    return mask
+
+def random_text(rng):
+    """
+    Text raster with a 5px padding, like the output of RenderFont.render_curved.
+    """
+    word = ''.join(rng.choice(list('abcdefghijklmnopqrstuvwxyzäöüß'), rng.randint(3,10)))
+    scale = rng.uniform(0.5,1.5)
+    (w,h),base = cv2.getTextSize(word, cv2.FONT_HERSHEY_SIMPLEX, scale, 2)
+    arr = np.zeros((h+base+10, w+10),'uint8')
+    cv2.putText(arr, word, (5,h+5), cv2.FONT_HERSHEY_SIMPLEX, scale, 255, 2, cv2.LINE_AA)
+    return arr
+
+def place(mask, text, search, fallback=None):
+    """
+    One placement attempt. Returns (search time, accepted).
+    """
+    t = time.time()
+    safemask = search(mask, text)
+    if fallback is not None and not np.any(safemask):
+        safemask = fallback(mask, text)
+    t = time.time() - t
+    if not np.any(safemask):
+        return t, False
+    locs = np.transpose(np.nonzero(safemask))
+    loc = locs[np.random.choice(locs.shape[0]),:]
+    h,w = text.shape
+    dil = cv2.dilate(text, np.ones((5,5),np.uint8), iterations=1)
+    mask[loc[0]:loc[0]+h, loc[1]:loc[1]+w] |= (255*(dil>0)).astype('uint8')
+    return t, True
+
+def run(name, search, fallback=None, nregions=50, nplace=12, seed=0):
+    rng = np.random.RandomState(seed)
+    times, accepted = [], []
+    for _ in range(nregions):
+        mask = random_region(rng)
+        for _ in range(nplace):
+            text = random_text(rng)
+            if np.any(np.r_[text.shape] > np.r_[mask.shape]):
+                continue
+            t,ok = place(mask, text, search, fallback)
+            times.append(t)
+            accepted.append(ok)
+    print('%-16s : %7.3f ms per search, acceptance %.3f (%d attempts)'%(
+          name, 1000*np.mean(times), np.mean(accepted), len(accepted)))
+
+
+if __name__ == '__main__':
+    run('fft', safe_locs_fft)
+    run('sat', safe_locs_sat)
+    run('sat + fallback', safe_locs_sat, fallback=safe_locs_fft)
@@ -0,0 +1,77 @@
+"""
+Benchmark of the drop-shadow of the text (Colorize.drop_shadow): compares
+the sub-pixel shift with scipy.ndimage.shift (cubic spline, the previous
+implementation) with the cv2.warpAffine translation now in use.
+
+Text alphas are synthetic, at patch sizes typical for the rendered text
+(with the 20px padding of Colorize.color), and the shadow parameters are
+drawn as in Colorize.process.
+Reports the time per shadow and the difference of the shadow alphas (the
+two only differ noticeably if the text touches the patch border: the
+spline extends the patch by mirroring within the last pixel, the warp
+uses zeros).
+"""
+
+import time
+import numpy as np
+import cv2
+import scipy.ndimage as sn
+from colorize3_poisson import Colorize
+
+
+def drop_shadow_spline(alpha, theta, shift, size, op=0.80):
+    """
+    Previous Colorize.drop_shadow, using scipy.ndimage.shift.
+    """
+    if size%2==0:
+        size -= 1
+        size = max(1,size)
+    shadow = cv2.GaussianBlur(alpha,(size,size),0)
+    [dx,dy] = shift * np.array([-np.sin(theta), np.cos(theta)])
+    shadow = op*sn.shift(shadow, shift=[dx,dy],mode='constant',cval=0)
+    return np.clip(shadow, 0, 255).astype('uint8')
+
+def random_alpha(rng, H):
+    """
+    Text alpha with a text height of about H px and the 20px padding of
+    Colorize.color, scaled as in Colorize.process.
+    """
+    word = ''.join(rng.choice(list('abcdefghijklmnopqrstuvwxyzäöüß'), rng.randint(4,10)))
+    scale = H/30.0
+    thickness = max(1,int(2*scale))
+    (w,h),base = cv2.getTextSize(word, cv2.FONT_HERSHEY_SIMPLEX, scale, thickness)
+    arr = np.zeros((h+base+40, w+40),'uint8')
+    cv2.putText(arr, word, (20,h+20), cv2.FONT_HERSHEY_SIMPLEX, scale, 255, thickness, cv2.LINE_AA)
+    return np.multiply(arr, np.clip(0.88+0.1*rng.randn(),0.72,1.0), dtype='float32')
+
+def shadow_params(rng, min_h):
+    if min_h <= 15 : bsz,shift = 1,2
+    elif 15 < min_h < 30: bsz,shift = 3,7+rng.randn()
+    else: bsz,shift = 5,15+3*rng.randn()
+    theta = np.pi/4 * rng.choice([1,3,5,7]) + 0.5*rng.randn()
+    return theta, shift, 3*bsz, 0.50+0.1*rng.randn()
+
+def timeit(f, args, nrep=20):
+    t = time.time()
+    for _ in range(nrep):
+        f(*args)
+    return (time.time()-t)/nrep
+
+
+if __name__=='__main__':
+    rng = np.random.RandomState(0)
+    colorizer = Colorize()
+    print('%12s %12s %12s %8s %10s %10s'%('patch','spline [ms]','warp [ms]','speedup','max diff','mean diff'))
+    for H,min_h in [(15,12),(30,25),(60,40),(140,80)]:
+        ts,tw,dmax,dmean = [],[],[],[]
+        for _ in range(10):
+            alpha = random_alpha(rng, H)
+            args = (alpha,) + shadow_params(rng, min_h)
+            s_ref = drop_shadow_spline(*args)
+            s_new = colorizer.drop_shadow(*args)
+            d = np.abs(s_ref.astype('int32')-s_new)
+            dmax.append(d.max()); dmean.append(d.mean())
+            ts.append(timeit(drop_shadow_spline,args))
+            tw.append(timeit(colorizer.drop_shadow,args))
+        ts,tw = 1e3*np.mean(ts),1e3*np.mean(tw)
+        print('%12s %12.3f %12.3f %7.1fx %10d %10.3f'%('%dx%d'%alpha.shape,ts,tw,ts/tw,np.max(dmax),np.mean(dmean)))
@@ -0,0 +1,35 @@
+"""
+Run this once after adding a new text source to convert it to the memory-mapped
+corpus read by TextSource (see text_utils.MappedCorpus):
+  <prefix>.blob        : UTF-8 text of the stripped lines
+  <prefix>.offsets.npy : uint64 line offsets into the blob
+and to build the length-bucketed index of its valid words (text_utils.WordIndex)
+at <prefix>.words.*, used by TextSource.sample_word, and the line/word statistics
+(text_utils.SegmentIndex) at <prefix>.segments.*, used by TextSource.get_lines.
+The prefix is the path of the text file without its extension, so TextSource
+picks up the corpus automatically.
+"""
+
+import argparse
+import os.path as osp
+from text_utils import MappedCorpus, WordIndex, SegmentIndex, TextSource
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Convert a text source to a memory-mapped corpus')
+    parser.add_argument('--txt',default=osp.join('data','german_textSource/3M_sentences_LeipzigCorpora.txt'),
+                        help='text file, one sentence per line')
+    args = parser.parse_args()
+
+    prefix = osp.splitext(args.txt)[0]
+    n = MappedCorpus.build(args.txt, prefix)
+    print('wrote %d lines to %s.blob / %s.offsets.npy'%(n,prefix,prefix))
+
+    # word index: keep the words which pass TextSource.is_good for any
+    # min_nchar, the length limits are applied when sampling:
+    text_source = TextSource(min_nchar=0, fn=args.txt)
+    n = WordIndex.build(text_source.txt, prefix+'.words', lambda w: text_source.is_good([w])[0])
+    print('wrote %d distinct words to %s.words.*'%(n,prefix))
+
+    n = SegmentIndex.build(text_source.txt, prefix+'.segments', TextSource.char_ex)
+    print('wrote statistics of %d words to %s.segments.*'%(n,prefix))
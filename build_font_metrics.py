@@ -0,0 +1,56 @@
+"""
+Run this after adding more fonts (or after updating the character model) to
+precompute the per-font metrics table: data/models/font_metrics.npy
+
+For every font in data/fonts/fontlist.txt it stores:
+  - the frequency-weighted mean aspect ratio of the char-model characters,
+  - the glyph coverage of the char-model (fraction of characters by frequency),
+  - the linear model which maps pixel height to font points (see invert_font_size.py).
+
+FontState memory-maps this table, so rendering only does a lookup per font.
+Building it changes which fonts are used only if FontState.min_glyph_coverage
+is set. The stored aspect ratios (~0.5-0.6) are only used if
+FontState.use_font_aspect_ratio is set. Otherwise the fallback ratio 1.0 is
+kept, because the real ratios change the sampled font heights and the number
+of characters per line.
+"""
+
+import argparse
+import os.path as osp
+import numpy as np
+import pygame
+from pygame import freetype
+from text_utils import FontState
+
+
+def px2pt_model(font, ys=np.arange(8,200)):
+    """
+    Least-squares fit of the font-size in points to the glyph height in pixels.
+    """
+    A = np.c_[ys,np.ones_like(ys)]
+    h = np.array([font.get_sized_glyph_height(float(y)) for y in ys])
+    m,_,_,_ = np.linalg.lstsq(A,h,rcond=None)
+    return m
+
+
+def main(data_dir, out_path):
+    FS = FontState(data_dir)
+    font_dir = osp.join(data_dir,'fonts')
+    table = np.zeros(len(FS.fonts), dtype=FontState.METRICS_DTYPE)
+    for i,fpath in enumerate(FS.fonts):
+        print('%d/%d: %s'%(i+1,len(FS.fonts),fpath))
+        font = freetype.Font(fpath, size=12)
+        table[i]['font'] = osp.relpath(fpath, font_dir)
+        table[i]['aspect_ratio'], table[i]['coverage'] = FS.compute_aspect_ratio(font)
+        table[i]['px2pt'] = px2pt_model(font)
+    np.save(out_path, table)
+    print('wrote metrics of %d fonts to %s'%(len(table),out_path))
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Precompute the per-font metrics table')
+    parser.add_argument('--data',default='data',help='data directory (fonts/ and models/)')
+    parser.add_argument('--out',default=None,help='output file, default: <data>/models/font_metrics.npy')
+    args = parser.parse_args()
+    pygame.init()
+    main(args.data, args.out or osp.join(args.data,'models/font_metrics.npy'))
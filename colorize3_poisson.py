@@ -3,7 +3,6 @@ import numpy as np
 import matplotlib.pyplot as plt 
 import scipy.interpolate as si
 import scipy.ndimage as scim 
-import scipy.ndimage.interpolation as sii
 import os
 import os.path as osp
 #import cPickle as cp
@@ -11,6 +10,7 @@ import _pickle as cp
 #import Image
 from PIL import Image
 from poisson_reconstruct import blit_images
+from param_sampler import get_sampler
 import pickle
 
 def sample_weighted(p_dict):
@@ -33,11 +33,12 @@ class Layer(object):
         color=np.atleast_1d(np.array(color)).astype('uint8')
         # color for the image:
         if color.ndim==1: # constant color for whole layer
+            # kept as a 1x1x3 image, which broadcasts against the alpha:
             ncol = color.size
             if ncol == 1 : #grayscale layer
-                self.color = color * np.ones((n,m,3),'uint8')
+                self.color = color * np.ones((1,1,3),'uint8')
             if ncol == 3 : 
-                self.color = np.ones((n,m,3),'uint8') * color[None,None,:]
+                self.color = color[None,None,:].copy()
         elif color.ndim==2: # grayscale image
             self.color = np.repeat(color[:,:,None],repeats=3,axis=2).copy().astype('uint8')
         elif color.ndim==3: #rgb image
@@ -70,7 +71,7 @@ class FontColor(object):
         sample from a normal distribution centered around COL_MEAN 
         with standard deviation = COL_STD.
         """
-        col_sample = col_mean + col_std * np.random.randn()
+        col_sample = col_mean + col_std * get_sampler().randn()
         return np.clip(col_sample, 0, 255).astype('uint8')
 
 
@@ -157,7 +158,8 @@ class FontColor(object):
         vs = np.linspace(0,1)
         ps = np.abs(vs - x/255.0)
         ps /= np.sum(ps)
-        v_rand = np.clip(np.random.choice(vs,p=ps) + 0.1*np.random.randn(),0,1)
+        S = get_sampler()
+        v_rand = np.clip(S.choice(vs,p=ps) + S.randn(0,0.1),0,1)
         col[2] = 255*v_rand
         return np.squeeze(cv.cvtColor(col[None,None,:],cv.COLOR_HSV2RGB))
 
@@ -196,8 +198,11 @@ class Colorize(object):
             size = max(1,size)
         shadow = cv.GaussianBlur(alpha,(size,size),0)
         [dx,dy] = shift * np.array([-np.sin(theta), np.cos(theta)])
-        shadow = op*sii.shift(shadow, shift=[dx,dy],mode='constant',cval=0)
-        return shadow.astype('uint8')
+        # sub-pixel translation by (dx,dy) (rows,cols), zero outside:
+        M = np.float32([[1,0,dy],[0,1,dx]])
+        shadow = cv.warpAffine(shadow, M, (shadow.shape[1],shadow.shape[0]),
+                               flags=cv.INTER_CUBIC, borderMode=cv.BORDER_CONSTANT, borderValue=0)
+        return np.clip(op*shadow, 0, 255).astype('uint8')
 
     def border(self, alpha, size, kernel_type='RECT'):
         """
@@ -223,22 +228,44 @@ class Colorize(object):
         ref: Chapter 7 (pg. 440 and pg. 444):
              http://partners.adobe.com/public/developer/en/pdf/PDFReference.pdf
         """
-        a_f = fore.alpha/255.0
-        a_b = back.alpha/255.0
-        c_f = fore.color
-        c_b = back.color
-
-        a_r = a_f + a_b - a_f*a_b
-        if blend_type != None:
-            c_blend = self.blend(c_f, c_b, blend_type)
-            c_r = (   ((1-a_f)*a_b)[:,:,None] * c_b
-                    + ((1-a_b)*a_f)[:,:,None] * c_f
-                    + (a_f*a_b)[:,:,None] * c_blend   )
-        else:
-            c_r = (   ((1-a_f)*a_b)[:,:,None] * c_b
-                    + a_f[:,:,None]*c_f    )
+        return self.merge_down([fore,back], [blend_type])
 
-        return Layer((255*a_r).astype('uint8'), c_r.astype('uint8'))
+    def merge_layers(self, layers, blends):
+        """
+        Fused alpha compositing of LAYERS (top to bottom) with BLENDS (n-1,
+        None for plain alpha blending), see merge_two.
+        Works in float32 on a single pair of accumulators; constant-color
+        layers are broadcast and never expanded to full images.
+        Returns the float32 alpha (0-1) and color (0-255) of the result.
+        """
+        n,m = layers[0].alpha.shape[:2]
+        back = layers[-1]
+        a_b = np.empty((n,m),'float32')
+        np.multiply(back.alpha, np.float32(1/255.0), out=a_b, casting='unsafe')
+        c_r = np.empty((n,m,3),'float32')
+        c_r[...] = back.color
+        a_f = np.empty((n,m),'float32')
+        w = np.empty((n,m,1),'float32')
+        for fore,blend_type in zip(layers[-2::-1], blends[::-1]):
+            np.multiply(fore.alpha, np.float32(1/255.0), out=a_f, casting='unsafe')
+            c_f = fore.color
+            c_blend = c_f if blend_type is None else self.blend(c_f, c_r, blend_type)
+
+            # c_r = (1-a_f)*a_b*c_b + (1-a_b)*a_f*c_f + a_f*a_b*c_blend:
+            np.multiply(1-a_f, a_b, out=w[:,:,0])
+            c_r *= w
+            if c_blend is c_f:
+                w[:,:,0] = a_f
+                c_r += w*c_f
+            else:
+                np.multiply(1-a_b, a_f, out=w[:,:,0])
+                c_r += w*c_f
+                np.multiply(a_f, a_b, out=w[:,:,0])
+                c_r += w*c_blend
+
+            # a_r = a_f + a_b - a_f*a_b:
+            a_b += a_f*(1-a_b)
+        return a_b, c_r
 
     def merge_down(self, layers, blends=None):
         """
@@ -251,14 +278,10 @@ class Colorize(object):
         """
         nlayers = len(layers)
         if nlayers > 1:
-            [n,m] = layers[0].alpha.shape[:2]
-            out_layer = layers[-1]
-            for i in range(-2,-nlayers-1,-1):
-                blend=None
-                if blends is not None:
-                    blend = blends[i+1]
-                    out_layer = self.merge_two(fore=layers[i], back=out_layer,blend_type=blend)
-            return out_layer
+            if blends is None:
+                blends = [None]*(nlayers-1)
+            a_r,c_r = self.merge_layers(layers, blends)
+            return Layer((255*a_r).astype('uint8'), c_r.astype('uint8'))
         else:
             return layers[0]
 
@@ -278,7 +301,8 @@ class Colorize(object):
             - could be the same as bg-color but lower/higher 'VALUE'.
             - could be 'mid-way' color b/w text & bg colors.
         """
-        choice = np.random.choice(3)
+        S = get_sampler()
+        choice = S.randint(3)
 
         col_text = cv.cvtColor(col_text, cv.COLOR_RGB2HSV)
         col_text = np.reshape(col_text, (np.prod(col_text.shape[:2]),3))
@@ -288,7 +312,7 @@ class Colorize(object):
         def get_sample(x):
             ps = np.abs(vs - x/255.0)
             ps /= np.sum(ps)
-            v_rand = np.clip(np.random.choice(vs,p=ps) + 0.1*np.random.randn(),0,1)
+            v_rand = np.clip(S.choice(vs,p=ps) + S.randn(0,0.1),0,1)
             return 255*v_rand
 
         # first choose a color, then inc/dec its VALUE:
@@ -343,12 +367,13 @@ class Colorize(object):
         bg_col = np.mean(np.mean(bg_arr,axis=0),axis=0)
         l_bg = Layer(alpha=255*np.ones_like(text_arr,'uint8'),color=bg_col)
 
-        l_text.alpha = l_text.alpha * np.clip(0.88 + 0.1*np.random.randn(), 0.72, 1.0)
+        S = get_sampler()
+        l_text.alpha = np.multiply(l_text.alpha, np.clip(S.randn(0.88,0.1), 0.72, 1.0), dtype='float32')
         layers = [l_text]
         blends = []
 
         # add border:
-        if np.random.rand() < self.p_border:
+        if S.rand() < self.p_border:
             if min_h <= 15 : bsz = 1
             elif 15 < min_h < 30: bsz = 3
             else: bsz = 5
@@ -358,22 +383,22 @@ class Colorize(object):
             blends.append('normal')
 
         # add shadow:
-        if np.random.rand() < self.p_drop_shadow:
+        if S.rand() < self.p_drop_shadow:
             # shadow gaussian size:
             if min_h <= 15 : bsz = 1
             elif 15 < min_h < 30: bsz = 3
             else: bsz = 5
 
             # shadow angle:
-            theta = np.pi/4 * np.random.choice([1,3,5,7]) + 0.5*np.random.randn()
+            theta = np.pi/4 * S.choice([1,3,5,7]) + S.randn(0,0.5)
 
             # shadow shift:
             if min_h <= 15 : shift = 2
-            elif 15 < min_h < 30: shift = 7+np.random.randn()
-            else: shift = 15 + 3*np.random.randn()
+            elif 15 < min_h < 30: shift = S.randn(7,1)
+            else: shift = S.randn(15,3)
 
             # opacity:
-            op = 0.50 + 0.1*np.random.randn()
+            op = S.randn(0.50,0.1)
 
             shadow = self.drop_shadow(l_text.alpha, theta, shift, 3*bsz, op)
             l_shadow = Layer(shadow, 0)
@@ -12,8 +12,16 @@ Entry-point for generating synthetic text images with the pre-processed backgrou
 import numpy as np
 import h5py
 import traceback
+import random
+import multiprocessing as mp
+import signal
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
 import os.path as osp
 from synthgen import *
+from scene_cache import SceneCache
+from image_store import COMPRESSIONS, encode_image, write_image
 from common import *
 import cv2 as cv
 import time
@@ -28,13 +36,30 @@ SECS_PER_IMG = 2 #max time per image in seconds
 # path to the data-file, containing image, depth and segmentation:
 DATA_PATH = 'data'
 DB_FNAME = osp.join(DATA_PATH,'dset_8000.h5')
+# the same data converted by prepare_dset.py (used instead if it exists):
+READY_DB_FNAME = osp.join(DATA_PATH,'dset_8000_ready.h5')
 # path to the output file
 OUT_FILE = 'results/SynthText_8000.h5'
+# storage of the output images (see image_store.py): none, gzip, lzf, png or jpeg
+OUT_COMPRESSION = 'none'
+# path to the pre-computed text-regions (see precompute_scenes.py):
+SCENE_CACHE = osp.join(DATA_PATH,'scene_cache.h5')
 
 # open the h5 file and return it
 def get_data():
+  if osp.exists(READY_DB_FNAME):
+    return h5py.File(READY_DB_FNAME,'r')
   return h5py.File(DB_FNAME,'r')
 
+# True if DB is a run-ready dataset written by prepare_dset.py:
+def is_ready_db(db):
+  return db.attrs.get('format') in ('ready',b'ready')
+
+# open the scene cache if it exists:
+def get_scene_cache():
+  if osp.exists(SCENE_CACHE):
+    return SceneCache(SCENE_CACHE,'r')
+
 
 def add_res_to_db(imgname,res,db):
   """
@@ -43,14 +68,21 @@ def add_res_to_db(imgname,res,db):
   """
   ninstance = len(res)
   for i in range(ninstance):
-    print(colorize(Color.YELLOW, 'added into ground truth: %s '%res[i]['txt']))
+    add_instance_to_db("%s_%d"%(imgname, i),res[i],db)
 
-    dname = "%s_%d"%(imgname, i)
-    db['data'].create_dataset(dname,data=res[i]['img'])
-    db['data'][dname].attrs['charBB'] = res[i]['charBB']
-    db['data'][dname].attrs['wordBB'] = res[i]['wordBB']
+def add_instance_to_db(dname,idict,db,compression='none',encoded=None):
+  """
+  Add a single instance IDICT (see RendererV3.render_text) as DNAME,
+  with the image stored in the layout COMPRESSION (ENCODED is its
+  pre-computed image_store.encode_image output, if any).
+  """
+  print(colorize(Color.YELLOW, 'added into ground truth: %s '%idict['txt']))
 
-    db['data'][dname].attrs['txt'] = res[i]['txt']
+  write_image(db['data'],dname,idict['img'],compression,encoded)
+  db['data'][dname].attrs['charBB'] = idict['charBB']
+  db['data'][dname].attrs['wordBB'] = idict['wordBB']
+
+  db['data'][dname].attrs['txt'] = idict['txt']
 
     #L = res[i]['txt']
     #L = [n.encode("utf-8", "ignore") for n in L]
@@ -60,17 +92,246 @@ def add_res_to_db(imgname,res,db):
     #db['data'][dname].attrs.create('txt', res[i]['txt'], dtype=h5py.vlen_dtype(np.dtype('U')))
 
 
-def main(viz=False):
+class ResultWriter(object):
+  """
+  Writes the rendered instances into the output dataset in a background
+  thread, so that writing overlaps rendering. The queue is bounded: when
+  the writer falls behind, put blocks, which keeps the memory flat.
+  The writer thread is the only one accessing the output dataset until
+  close is called.
+  The images are compressed / encoded (COMPRESSION, see image_store.py)
+  by a pool of NTHREADS threads before being written.
+  """
+  def __init__(self,db,maxsize=4,compression='none',nthreads=2):
+    self.db = db
+    self.compression = compression
+    self.queue = queue.Queue(maxsize)
+    self.encoder = None
+    if compression not in ('none','lzf'):
+      self.encoder = ThreadPoolExecutor(nthreads)
+    self.thread = threading.Thread(target=self._run,daemon=True)
+    self.thread.start()
+
+  def put(self,dname,idict):
+    encoded = None
+    if self.encoder is not None:
+      encoded = self.encoder.submit(encode_image,idict['img'],self.compression)
+    self.queue.put((dname,idict,encoded))
+
+  def _run(self):
+    while True:
+      item = self.queue.get()
+      if item is None:
+        break
+      try:
+        dname,idict,encoded = item
+        if encoded is not None:
+          encoded = encoded.result()
+        add_instance_to_db(dname,idict,self.db,self.compression,encoded)
+      except:
+        traceback.print_exc()
+        print (colorize(Color.GREEN,'>>>> failed to write %s, CONTINUING....'%item[0], bold=True))
+
+  def close(self):
+    """
+    Writes the remaining instances and stops the thread.
+    """
+    self.queue.put(None)
+    self.thread.join()
+    if self.encoder is not None:
+      self.encoder.shutdown()
+
+
+def load_scene(db,imname,depth_channel=1):
+  """
+  Read the image, depth and segmentation of IMNAME from the input
+  dataset and bring them to a common resolution.
+  Returns the tuple (img,depth,seg,area,label) expected by render_text.
+  A run-ready dataset (see prepare_dset.py) is read as is.
+  """
+  if is_ready_db(db):
+    img = db['image'][imname][:]
+    depth = db['depth'][imname][:].astype('float32')
+    seg = db['seg'][imname][:].astype('float32')
+    area = db['seg'][imname].attrs['area']
+    label = db['seg'][imname].attrs['label']
+    return img,depth,seg,area,label
+
+  # get the image:
+  img = Image.fromarray(db['image'][imname][:])
+  # get the pre-computed depth:
+  #  there are 2 estimates of depth (represented as 2 "channels")
+  #  by default we are using the second one (in some cases it might be
+  #  useful to use the other one, DEPTH_CHANNEL=0):
+  depth = db['depth'][imname][:].T
+  depth = depth[:,:,depth_channel]
+  # get segmentation:
+  seg = db['seg'][imname][:].astype('float32')
+  area = db['seg'][imname].attrs['area']
+  label = db['seg'][imname].attrs['label']
+
+  # re-size uniformly:
+  sz = depth.shape[:2][::-1]
+  img = np.array(img.resize(sz,Image.LANCZOS)) # (ANTIALIAS was an alias of LANCZOS)
+  seg = np.array(Image.fromarray(seg).resize(sz,Image.NEAREST))
+  return img,depth,seg,area,label
+
+
+class ScenePrefetcher(object):
+  """
+  Loads the scenes of IMNAMES (load_scene and the pre-computed regions
+  from CACHE) in a background thread, up to DEPTH scenes ahead of the
+  renderer, so that reading and resizing overlap rendering.
+  Iterating yields (imname, scene, regions, error) in the order of
+  IMNAMES: SCENE is the tuple of load_scene, or None if loading failed
+  (then ERROR is the formatted traceback).
+  With DEPTH=0 the scenes are loaded synchronously, while iterating.
+  The reader thread is the only one accessing DB and CACHE until close.
+  """
+  def __init__(self,db,imnames,cache=None,depth=4):
+    self.db = db
+    self.imnames = imnames
+    self.cache = cache
+    self.depth = depth
+    self.stop = threading.Event()
+    self.thread = None
+    if depth > 0:
+      self.queue = queue.Queue(depth)
+      self.thread = threading.Thread(target=self._run,daemon=True)
+      self.thread.start()
+
+  def load(self,imname):
+    try:
+      scene = load_scene(self.db,imname)
+      regions = self.cache.get(imname) if self.cache is not None else None
+      return imname,scene,regions,None
+    except:
+      return imname,None,None,traceback.format_exc()
+
+  def _run(self):
+    for imname in self.imnames:
+      if not self._put(self.load(imname)):
+        return
+    self._put(None)
+
+  def _put(self,item):
+    # blocks while the queue is full, unless closed:
+    while not self.stop.is_set():
+      try:
+        self.queue.put(item,timeout=0.1)
+        return True
+      except queue.Full:
+        continue
+    return False
+
+  def __iter__(self):
+    if self.thread is None:
+      for imname in self.imnames:
+        if self.stop.is_set():
+          return
+        yield self.load(imname)
+      return
+    while True:
+      item = self.queue.get()
+      if item is None:
+        return
+      yield item
+
+  def close(self):
+    """
+    Stops the reader thread (the remaining scenes are not loaded).
+    """
+    self.stop.set()
+    if self.thread is not None:
+      self.thread.join()
+
+
+# per-process state of the generation workers:
+_worker = {}
+
+def init_worker():
+  """
+  Initializer of the worker processes: every worker opens its own
+  handle to the input dataset and owns its own renderer, as the
+  pygame/freetype state cannot be shared between processes.
+  """
+  # forked workers inherit the random state of the parent:
+  np.random.seed()
+  random.seed()
+  _worker['db'] = get_data()
+  _worker['cache'] = get_scene_cache()
+  _worker['renderer'] = RendererV3(DATA_PATH,max_time=SECS_PER_IMG)
+  # pygame.init() (in the renderer) installs SDL's SIGTERM handler, which
+  # would keep Pool.terminate from stopping the worker:
+  signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+def render_worker(imname):
+  """
+  Render INSTANCE_PER_IMAGE instances of IMNAME in a worker process.
+  Returns (imname, list of results); the list is empty on failure.
+  """
+  try:
+    img,depth,seg,area,label = load_scene(_worker['db'],imname)
+    regions = _worker['cache'].get(imname) if _worker['cache'] is not None else None
+    res = _worker['renderer'].render_text(img,depth,seg,area,label,
+                                          ninstance=INSTANCE_PER_IMAGE,viz=False,
+                                          regions=regions)
+  except:
+    traceback.print_exc()
+    print (colorize(Color.GREEN,'>>>> CONTINUING....', bold=True))
+    res = []
+  return imname,res
+
+
+def open_output(compression):
+  """
+  Creates the output h5 file (OUT_FILE) with its group 'data'.
+  """
+  out_db = h5py.File(OUT_FILE,'w')
+  out_db.create_group('/data')
+  print (colorize(Color.GREEN,'Storing the output in: %s (images: %s)'%(OUT_FILE,compression), bold=True))
+  return out_db
+
+def main_parallel(imnames,nworkers,compression='none',encode_threads=2):
+  """
+  Distribute IMNAMES over a pool of NWORKERS processes.
+  The results are written by a single writer thread of this process
+  as they come in.
+  """
+  print (colorize(Color.BLUE,'rendering with %d worker processes'%nworkers, bold=True))
+  # start the workers before the output is opened (and the writer threads run):
+  pool = mp.Pool(nworkers,initializer=init_worker)
+  out_db,writer = None,None
+  t1 = time.time()
+  try:
+    out_db = open_output(compression)
+    writer = ResultWriter(out_db,compression=compression,nthreads=encode_threads)
+    for i,(imname,res) in enumerate(pool.imap_unordered(render_worker,imnames,chunksize=1)):
+      print (colorize(Color.BLUE,'%d of %d : %s'%(i,len(imnames)-1,imname), bold=True))
+      # non-empty : successful in placing text:
+      for j in range(len(res)):
+        writer.put("%s_%d"%(imname,j),res[j])
+      del res
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+    if writer is not None:
+      writer.close()
+    if out_db is not None:
+      out_db.close()
+  t2 = time.time()
+  print(colorize(Color.BLUE, f'time per image instance: {(t2-t1)/max(1,len(imnames)*INSTANCE_PER_IMAGE)}', bold=True))
+
+
+def main(viz=False,nworkers=1,instance_workers=1,compression=OUT_COMPRESSION,encode_threads=2,prefetch=4):
   # open databases:
   print (colorize(Color.BLUE,'getting data..',bold=True))
   db = get_data()
   print (colorize(Color.BLUE,'\t-> done',bold=True))
 
-  # open the output h5 file:
-  out_db = h5py.File(OUT_FILE,'w')
-  out_db.create_group('/data')
-  print (colorize(Color.GREEN,'Storing the output in: '+OUT_FILE, bold=True))
-
   # get the names of the image files in the dataset:
   imnames = sorted(db['image'].keys())
   N = len(imnames)
@@ -79,45 +340,49 @@ def main(viz=False):
     NUM_IMG = N
   start_idx,end_idx = 0,min(NUM_IMG, N)
 
-  RV3 = RendererV3(DATA_PATH,max_time=SECS_PER_IMG)
+  if nworkers > 1:
+    if viz:
+      warn('visualizations are not supported with multiple workers, ignoring --viz')
+    if instance_workers > 1:
+      warn('--instance-workers is ignored when rendering with multiple workers')
+    db.close()
+    main_parallel(imnames[start_idx:end_idx],nworkers,compression,encode_threads)
+    return
+
+  # created before the writer/prefetcher threads start, as it forks the instance workers:
+  RV3 = RendererV3(DATA_PATH,max_time=SECS_PER_IMG,instance_workers=instance_workers)
+  cache = get_scene_cache()
+  if cache is not None:
+    print (colorize(Color.GREEN,'using the pre-computed text-regions in: '+SCENE_CACHE, bold=True))
+  out_db = open_output(compression)
 
-  for i in range(start_idx,end_idx):
+  # the instances are written by a background thread as they are rendered,
+  # and the scenes are loaded ahead by another one:
+  done = set(out_db['data'].keys())
+  todo = [(i,imnames[i]) for i in range(start_idx,end_idx) if imnames[i] not in done]
+  writer = ResultWriter(out_db,compression=compression,nthreads=encode_threads)
+  prefetcher = ScenePrefetcher(db,[imname for _,imname in todo],cache,depth=prefetch)
+  for (i,_),(imname,scene,regions,error) in zip(todo,prefetcher):
     t1=time.time() # variable that holds the starting time
 
-    imname = imnames[i]
     print(i, imname)
 
-    if imname in out_db['data'].keys():
-        continue
-
     try:
-      # get the image:
-      img = Image.fromarray(db['image'][imname][:])
-      # get the pre-computed depth:
-      #  there are 2 estimates of depth (represented as 2 "channels")
-      #  here we are using the second one (in some cases it might be
-      #  useful to use the other one):
-      depth = db['depth'][imname][:].T
-      depth = depth[:,:,1]
-      # get segmentation:
-      seg = db['seg'][imname][:].astype('float32')
-      area = db['seg'][imname].attrs['area']
-      label = db['seg'][imname].attrs['label']
-
-      # re-size uniformly:
-      sz = depth.shape[:2][::-1]
-      img = np.array(img.resize(sz,Image.ANTIALIAS))
-      seg = np.array(Image.fromarray(seg).resize(sz,Image.NEAREST))
+      if scene is None:
+        raise Exception('failed to load %s:\n%s'%(imname,error))
+      img,depth,seg,area,label = scene
+      del scene
 
       print (colorize(Color.BLUE,'%d of %d'%(i,end_idx-1), bold=True))
-      res = RV3.render_text(img,depth,seg,area,label,
-                            ninstance=INSTANCE_PER_IMAGE,viz=viz)
+      ninstance = 0
+      for idict in RV3.render_text_iter(img,depth,seg,area,label,
+                                        ninstance=INSTANCE_PER_IMAGE,viz=viz,
+                                        regions=regions):
+        # successful in placing text:
+        writer.put("%s_%d"%(imname,ninstance),idict)
+        ninstance += 1
       t2=time.time() # endtime 
       print(colorize(Color.BLUE, f'time per image instance: {(t2-t1)/INSTANCE_PER_IMAGE}', bold=True))
-
-      if len(res) > 0:
-        # non-empty : successful in placing text:
-        add_res_to_db(imname,res,out_db)
     
       # visualize the output:
       if viz:
@@ -127,16 +392,26 @@ def main(viz=False):
       traceback.print_exc()
       print (colorize(Color.GREEN,'>>>> CONTINUING....', bold=True))
       continue
+  prefetcher.close()
+  writer.close()
+  RV3.close()
   db.close()
   out_db.close()
+  if cache is not None:
+    cache.close()
 
 
 if __name__=='__main__':
   import argparse
   parser = argparse.ArgumentParser(description='Genereate Synthetic Scene-Text Images')
   parser.add_argument('--viz',action='store_true',dest='viz',default=False,help='flag for turning on visualizations')
+  parser.add_argument('--workers',type=int,dest='workers',default=1,help='number of worker processes rendering in parallel')
+  parser.add_argument('--instance-workers',type=int,dest='instance_workers',default=1,help='number of processes rendering the instances of one image in parallel (only used with --workers 1)')
+  parser.add_argument('--compression',choices=COMPRESSIONS,default=OUT_COMPRESSION,help='storage of the output images (see image_store.py)')
+  parser.add_argument('--encode-threads',type=int,dest='encode_threads',default=2,help='number of threads compressing/encoding the output images')
+  parser.add_argument('--prefetch',type=int,default=4,help='number of input scenes loaded ahead by a reader thread (0 to load synchronously, only used with --workers 1)')
   args = parser.parse_args()
-  main(args.viz)
+  main(args.viz,args.workers,args.instance_workers,args.compression,args.encode_threads,args.prefetch)
   # profiling
   #import cProfile, pstats 
   #profiler = cProfile.Profile()
@@ -0,0 +1,82 @@
+"""
+Storage of the rendered images in the output h5 dataset.
+
+Every instance is one dataset in the group 'data' (with the attributes
+charBB, wordBB and txt). Its image is stored in one of the layouts:
+  none : uncompressed HxWx3 uint8 array (the original layout)
+  gzip : HxWx3 uint8 array in a single gzip-compressed chunk
+  lzf  : HxWx3 uint8 array, lzf-compressed chunks
+  png  : 1-D uint8 array of the PNG-encoded image (lossless)
+  jpeg : 1-D uint8 array of the JPEG-encoded image (lossy)
+The layout is stored in the attribute 'encoding' of the dataset (absent
+for 'none'), read_image decodes all of them.
+
+encode_image does the expensive part (compression / encoding) without
+touching the h5 file, so that it can run in a pool of threads (zlib and
+OpenCV release the GIL), and write_image only writes the result.
+"""
+
+import zlib
+import numpy as np
+import cv2
+
+COMPRESSIONS = ('none','gzip','lzf','png','jpeg')
+GZIP_LEVEL = 4
+PNG_LEVEL = 3
+JPEG_QUALITY = 95
+
+
+def encode_image(img, compression):
+    """
+    Returns the encoded IMG (HxWx3 RGB uint8) for the layout COMPRESSION,
+    to be passed to write_image.
+    """
+    if compression in ('none','lzf'): # lzf is applied by the HDF5 filter
+        return img
+    elif compression == 'gzip':
+        return zlib.compress(np.ascontiguousarray(img).tobytes(), GZIP_LEVEL)
+    elif compression in ('png','jpeg'):
+        bgr = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+        if compression == 'png':
+            ok,buf = cv2.imencode('.png', bgr, [cv2.IMWRITE_PNG_COMPRESSION, PNG_LEVEL])
+        else:
+            ok,buf = cv2.imencode('.jpg', bgr, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+        if not ok:
+            raise Exception('could not encode the image as %s'%compression)
+        return buf.ravel()
+    raise ValueError('unknown compression: %s'%compression)
+
+def write_image(group, dname, img, compression, encoded=None):
+    """
+    Creates the dataset DNAME in GROUP holding IMG in the layout COMPRESSION.
+    ENCODED is the output of encode_image (computed here if None).
+    Returns the dataset.
+    """
+    if encoded is None:
+        encoded = encode_image(img, compression)
+    if compression == 'none':
+        dset = group.create_dataset(dname, data=img)
+    elif compression == 'lzf':
+        dset = group.create_dataset(dname, data=img, chunks=True, compression='lzf')
+    elif compression == 'gzip':
+        dset = group.create_dataset(dname, shape=img.shape, dtype=img.dtype, chunks=img.shape,
+                                    compression='gzip', compression_opts=GZIP_LEVEL)
+        dset.id.write_direct_chunk((0,)*img.ndim, encoded)
+    else:
+        dset = group.create_dataset(dname, data=encoded)
+        dset.attrs['shape'] = img.shape
+    if compression != 'none':
+        dset.attrs['encoding'] = compression
+    return dset
+
+def read_image(dset):
+    """
+    Returns the RGB image stored in the dataset DSET, in any of the layouts.
+    """
+    encoding = dset.attrs.get('encoding', 'none')
+    if isinstance(encoding, bytes):
+        encoding = encoding.decode('utf-8')
+    if encoding in ('png','jpeg'):
+        bgr = cv2.imdecode(dset[...], cv2.IMREAD_COLOR)
+        return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+    return dset[...]
@@ -0,0 +1,98 @@
+"""
+Block-sampled random parameters for the text rendering.
+
+The render parameters (font-state, text lengths, baselines, colors, ...)
+are drawn one at a time, and per-call overhead of np.random and
+especially of scipy.stats distributions dominates drawing them.
+ParamSampler draws each distribution in large vectorized blocks from its
+own numpy.random.Generator and hands the values out one by one, refilling
+a block only when it is used up.
+
+get_sampler() returns the sampler of the current process: a new one
+(seeded from fresh entropy) is created in every (forked) worker process.
+"""
+
+import os
+import numpy as np
+
+
+class ParamSampler(object):
+    """
+    Pools of pre-drawn values of the distributions used for rendering.
+    """
+    def __init__(self, seed=None, block_size=4096):
+        self.block_size = block_size
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        """
+        Re-seeds the generator and drops the pre-drawn values.
+        """
+        self.rng = np.random.default_rng(seed)
+        self.pools = {}
+
+    def _next(self, key, draw):
+        """
+        Returns the next value of the pool KEY, the pool is (re-)filled
+        with DRAW(block_size) when empty.
+        """
+        pool = self.pools.get(key)
+        if not pool:
+            pool = draw(self.block_size).tolist()
+            pool.reverse()
+            self.pools[key] = pool
+        return pool.pop()
+
+    def rand(self):
+        """
+        Uniform in [0,1).
+        """
+        return self._next('uniform', self.rng.random)
+
+    def randn(self, mu=0.0, sigma=1.0):
+        """
+        Normal with mean MU and standard deviation SIGMA.
+        """
+        return mu + sigma*self._next('normal', self.rng.standard_normal)
+
+    def beta(self, a, b):
+        """
+        Beta distribution with parameters A, B.
+        """
+        return self._next(('beta',a,b), lambda n: self.rng.beta(a,b,n))
+
+    def randint(self, n):
+        """
+        Uniform integer in [0,N).
+        """
+        return min(int(self.rand()*n), n-1)
+
+    def choice(self, seq, p=None):
+        """
+        Random element of SEQ, with probabilities P (uniform if None).
+        """
+        if p is None:
+            return seq[self.randint(len(seq))]
+        cp = np.cumsum(p)
+        i = int(np.searchsorted(cp, self.rand()*cp[-1], side='right'))
+        return seq[min(i, len(seq)-1)]
+
+
+_sampler = None
+_sampler_pid = None
+
+def get_sampler():
+    """
+    Returns the ParamSampler of this process.
+    """
+    global _sampler, _sampler_pid
+    if _sampler is None or _sampler_pid != os.getpid():
+        _sampler = ParamSampler()
+        _sampler_pid = os.getpid()
+    return _sampler
+
+def seed_sampler(seed=None):
+    """
+    Re-seeds the ParamSampler of this process (e.g. for reproducible runs).
+    """
+    get_sampler().seed(seed)
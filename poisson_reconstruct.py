@@ -8,57 +8,58 @@ Paper: http://www.cs.jhu.edu/~misha/Fall07/Papers/Perez03.pdf
 """
 from __future__ import division
 import numpy as np 
-import scipy.fftpack
+import scipy.fft
 import scipy.ndimage
 import cv2
 import matplotlib.pyplot as plt 
+from functools import lru_cache
 #sns.set(style="darkgrid")
 
+# number of threads used for the sine transforms:
+FFT_WORKERS = 1
 
-def DST(x):
-    """
-    Converts Scipy's DST output to Matlab's DST (scaling).
-    """
-    X = scipy.fftpack.dst(x,type=1,axis=0)
-    return X/2.0
-
-def IDST(X):
-    """
-    Inverse DST. Python -> Matlab
-    """
-    n = X.shape[0]
-    x = np.real(scipy.fftpack.idst(X,type=1,axis=0))
-    return x/(n+1.0)
 
 def get_grads(im):
     """
     return the x and y gradients.
+    IM : HxW or HxWxC image (the channels are processed independently).
     """
-    [H,W] = im.shape
-    Dx,Dy = np.zeros((H,W),'float32'), np.zeros((H,W),'float32')
-    j,k = np.atleast_2d(np.arange(0,H-1)).T, np.arange(0,W-1)
-    Dx[j,k] = im[j,k+1] - im[j,k]
-    Dy[j,k] = im[j+1,k] - im[j,k]
+    Dx,Dy = np.zeros(im.shape,'float32'), np.zeros(im.shape,'float32')
+    Dx[:-1,:-1] = im[:-1,1:] - im[:-1,:-1]
+    Dy[:-1,:-1] = im[1:,:-1] - im[:-1,:-1]
     return Dx,Dy
 
 def get_laplacian(Dx,Dy):
     """
     return the laplacian
     """
-    [H,W] = Dx.shape
-    Dxx, Dyy = np.zeros((H,W)), np.zeros((H,W))
-    j,k = np.atleast_2d(np.arange(0,H-1)).T, np.arange(0,W-1)
-    Dxx[j,k+1] = Dx[j,k+1] - Dx[j,k] 
-    Dyy[j+1,k] = Dy[j+1,k] - Dy[j,k]
+    Dxx, Dyy = np.zeros(Dx.shape), np.zeros(Dx.shape)
+    Dxx[:-1,1:] = Dx[:-1,1:] - Dx[:-1,:-1]
+    Dyy[1:,:-1] = Dy[1:,:-1] - Dy[:-1,:-1]
     return Dxx+Dyy
 
+@lru_cache(maxsize=128)
+def get_dst_denominator(H,W):
+    """
+    Eigenvalues of the laplacian in the DST basis, for the
+    (H-2)x(W-2) interior of an HxW image. Cached per size (read-only).
+    """
+    [xx,yy] = np.meshgrid(np.arange(1,W-1),np.arange(1,H-1))
+    D = (2*np.cos(np.pi*xx/(W-1))-2) + (2*np.cos(np.pi*yy/(H-1))-2)
+    D.setflags(write=False)
+    return D
+
 def poisson_solve(gx,gy,bnd):
+    """
+    Solves for the image with gradients (GX,GY) and the boundary of BND.
+    All inputs are HxW or HxWxC (all the channels are solved at once).
+    """
     # convert to double:
     gx = gx.astype('float32')
     gy = gy.astype('float32')
     bnd = bnd.astype('float32')
  
-    H,W = bnd.shape
+    H,W = bnd.shape[:2]
     L = get_laplacian(gx,gy)
 
     # set the interior of the boundary-image to 0:
@@ -71,15 +72,18 @@ def poisson_solve(gx,gy,bnd):
     L = L - L_bp
     L = L[1:-1,1:-1]
 
-    # compute the 2D DST:
-    L_dst = DST(DST(L).T).T #first along columns, then along rows
+    # compute the 2D DST (along columns and rows):
+    L_dst = scipy.fft.dstn(L,type=1,axes=(0,1),workers=FFT_WORKERS)
 
     # normalize:
-    [xx,yy] = np.meshgrid(np.arange(1,W-1),np.arange(1,H-1))
-    D = (2*np.cos(np.pi*xx/(W-1))-2) + (2*np.cos(np.pi*yy/(H-1))-2)
-    L_dst = L_dst/D
+    D = get_dst_denominator(H,W)
+    if L.ndim == 3:
+        D = D[:,:,None]
+    L_dst /= D
 
-    img_interior = IDST(IDST(L_dst).T).T # inverse DST for rows and columns
+    # inverse DST for rows and columns (the scaling of the
+    # forward and inverse transforms cancels):
+    img_interior = scipy.fft.idstn(L_dst,type=1,axes=(0,1),workers=FFT_WORKERS)
 
     img = bnd.copy()
 
@@ -96,51 +100,47 @@ def blit_images(im_top,im_back,scale_grad=1.0,mode='src'):
 
     im_top = im_top.copy().astype('float32')
     im_back = im_back.copy().astype('float32')
-    im_res = np.zeros_like(im_top)
 
+    # all the channels are processed together:
+    [gxs,gys] = get_grads(im_top)
+    [gxd,gyd] = get_grads(im_back)
+
+    gxs *= scale_grad
+    gys *= scale_grad
+
+    gxs_idx = gxs!=0
+    gys_idx = gys!=0
     # frac of gradients which come from source:
-    for ch in range(im_top.shape[2]):
-        ims = im_top[:,:,ch]
-        imd = im_back[:,:,ch]
-
-        [gxs,gys] = get_grads(ims)
-        [gxd,gyd] = get_grads(imd)
-
-        gxs *= scale_grad
-        gys *= scale_grad
-
-        gxs_idx = gxs!=0
-        gys_idx = gys!=0
-        # mix the source and target gradients:
-        if mode=='max':
-            gx = gxs.copy()
-            gxm = (np.abs(gxd))>np.abs(gxs)
-            gx[gxm] = gxd[gxm]
-
-            gy = gys.copy()
-            gym = np.abs(gyd)>np.abs(gys)
-            gy[gym] = gyd[gym]
-
-            # get gradient mixture statistics:
-            f_gx = np.sum((gx[gxs_idx]==gxs[gxs_idx]).flat) / (np.sum(gxs_idx.flat)+1e-6)
-            f_gy = np.sum((gy[gys_idx]==gys[gys_idx]).flat) / (np.sum(gys_idx.flat)+1e-6)
-            if min(f_gx, f_gy) <= 0.35:
-                m = 'max'
-                if scale_grad > 1:
-                    m = 'blend'
-                return blit_images(im_top, im_back, scale_grad=1.5, mode=m)
-
-        elif mode=='src':
-            gx,gy = gxd.copy(), gyd.copy()
-            gx[gxs_idx] = gxs[gxs_idx]
-            gy[gys_idx] = gys[gys_idx]
-
-        elif mode=='blend': # from recursive call:
-            # just do an alpha blend
-            gx = gxs+gxd
-            gy = gys+gyd
-
-        im_res[:,:,ch] = np.clip(poisson_solve(gx,gy,imd),0,255)
+    # mix the source and target gradients:
+    if mode=='max':
+        gx = gxs.copy()
+        gxm = (np.abs(gxd))>np.abs(gxs)
+        gx[gxm] = gxd[gxm]
+
+        gy = gys.copy()
+        gym = np.abs(gyd)>np.abs(gys)
+        gy[gym] = gyd[gym]
+
+        # get gradient mixture statistics (per channel):
+        f_gx = np.sum((gx==gxs) & gxs_idx, axis=(0,1)) / (np.sum(gxs_idx, axis=(0,1))+1e-6)
+        f_gy = np.sum((gy==gys) & gys_idx, axis=(0,1)) / (np.sum(gys_idx, axis=(0,1))+1e-6)
+        if min(np.min(f_gx), np.min(f_gy)) <= 0.35:
+            m = 'max'
+            if scale_grad > 1:
+                m = 'blend'
+            return blit_images(im_top, im_back, scale_grad=1.5, mode=m)
+
+    elif mode=='src':
+        gx,gy = gxd.copy(), gyd.copy()
+        gx[gxs_idx] = gxs[gxs_idx]
+        gy[gys_idx] = gys[gys_idx]
+
+    elif mode=='blend': # from recursive call:
+        # just do an alpha blend
+        gx = gxs+gxd
+        gy = gys+gyd
+
+    im_res = np.clip(poisson_solve(gx,gy,im_back),0,255)
 
     return im_res.astype('uint8')
 
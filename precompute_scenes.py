@@ -0,0 +1,77 @@
+"""
+Pre-compute the scene analysis (text-regions, planes, placement masks and
+homographies) of every background image in the input dataset and store it
+in the scene cache. gen_more.py loads the cache and skips straight to text
+placement for the cached images.
+Re-run this after changing the TextRegions parameters.
+"""
+
+import numpy as np
+import traceback
+import multiprocessing as mp
+import signal
+from common import *
+from synthgen import SceneAnalyzer
+from scene_cache import SceneCache
+import gen_more
+
+
+# per-process state of the analysis workers:
+_worker = {}
+
+def init_worker():
+  # the analysis needs no fonts, corpus or pygame (whose SDL SIGTERM handler
+  # would keep Pool.terminate from stopping the worker), make sure that
+  # terminate works anyway:
+  signal.signal(signal.SIGTERM, signal.SIG_DFL)
+  _worker['db'] = gen_more.get_data()
+  _worker['analyzer'] = SceneAnalyzer()
+
+def analyze_worker(imname):
+  """
+  Returns (imname, regions), regions is None if the analysis failed.
+  """
+  try:
+    _,depth,seg,area,label = gen_more.load_scene(_worker['db'],imname)
+    regions = _worker['analyzer'].analyze_scene(depth,seg,area,label)
+  except:
+    traceback.print_exc()
+    regions = None
+  return imname,regions
+
+
+def main(cache_fname,nworkers=1,overwrite=False):
+  db = gen_more.get_data()
+  imnames = sorted(db['image'].keys())
+  db.close()
+
+  cache = SceneCache(cache_fname,'a')
+  if not overwrite:
+    imnames = [n for n in imnames if n not in cache]
+  print (colorize(Color.GREEN,'analyzing %d images, storing in: %s'%(len(imnames),cache_fname), bold=True))
+
+  pool = mp.Pool(nworkers,initializer=init_worker)
+  try:
+    for i,(imname,regions) in enumerate(pool.imap_unordered(analyze_worker,imnames,chunksize=1)):
+      if regions is None:
+        continue
+      cache.put(imname,regions)
+      print (colorize(Color.BLUE,'%d of %d : %s (%d regions)'%(i,len(imnames)-1,imname,len(regions['place_mask']))))
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+    cache.close()
+  print (colorize(Color.GREEN,'\t-> done',bold=True))
+
+
+if __name__=='__main__':
+  import argparse
+  parser = argparse.ArgumentParser(description='Pre-compute the text-regions of the background images')
+  parser.add_argument('--out',dest='out',default=gen_more.SCENE_CACHE,help='path of the scene cache')
+  parser.add_argument('--workers',type=int,dest='workers',default=mp.cpu_count(),help='number of worker processes')
+  parser.add_argument('--overwrite',action='store_true',dest='overwrite',default=False,help='re-compute images which are already cached')
+  args = parser.parse_args()
+  main(args.out,args.workers,args.overwrite)
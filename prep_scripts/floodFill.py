@@ -10,123 +10,192 @@ import numpy as np
 import matplotlib.pyplot as plt
 import cv2
 import scipy.io as sio
+import scipy.ndimage as sim
 import h5py
-import os.path as osp
+import os, os.path as osp
 import multiprocessing as mp
 import traceback, sys
+import collections, itertools, queue
 
-def get_seed(sx,sy,ucm):
-    n = sx.size
-    for i in range(n):
-        if ucm[sx[i]+1,sy[i]+1] == 0:
-            return (sy[i],sx[i])
-
-def get_mask(ucm,viz=False):
-    ucm = ucm.copy()
-    h,w = ucm.shape[:2]
-    mask = np.zeros((h-2,w-2),'float32')
-
-    i = 0
-    sx,sy = np.where(mask==0)
-    seed = get_seed(sx,sy,ucm)
-    areas = []
-    labels=[]
-    while seed is not None and i<1000:
-        cv2.floodFill(mask,ucm,seed,i+1)
-        # calculate the area (no. of pixels):
-        areas.append(np.sum(mask==i+1))
-        labels.append(i+1)
-
-        # get the location of the next seed:
-        sx,sy = np.where(mask==0)
-        seed = get_seed(sx,sy,ucm)
-        i += 1
-    print ("  > terminated in %d steps"%i)
-
+def get_mask(ucm,viz=False,max_segments=1000):
+    """
+    Labels the segments of the binary UCM (1 on the contours): the
+    4-connected components of the pixels off the contours, in the
+    inner (h-2)x(w-2) part of UCM.
+    The labels 1..n are in raster-scan order of the first pixel of each
+    segment, at most MAX_SEGMENTS segments are labelled (the others
+    are left 0, as the contours).
+    Returns the float32 label mask, and the areas and labels.
+    """
+    free = ucm[1:-1,1:-1] == 0
+    seg,n = sim.label(free, structure=[[0,1,0],[1,1,1],[0,1,0]])
+    n = min(n, max_segments)
+    seg[seg > n] = 0
+    areas = np.bincount(seg.ravel(), minlength=n+1)[1:n+1]
+    print ("  > found %d segments"%n)
+
+    mask = seg.astype('float32')
     if viz:
         plt.imshow(mask)
         plt.show()
 
-    return mask,np.array(areas),np.array(labels)
+    if n == 0:
+        return mask,np.array([]),np.array([])
+    return mask,areas,np.arange(1,n+1)
+
+# per-process state of the segmentation workers:
+_worker = {}
+
+def read_imname(ucm_h5,i):
+    return "".join(map(chr, ucm_h5[ucm_h5['names'][0,i]][:].ravel()))
+
+def init_worker(db_path,th):
+    _worker['ucm_h5'] = h5py.File(db_path,'r')
+    _worker['th'] = th
 
-def get_mask_parallel(ucm_imname):
-    ucm,imname = ucm_imname
+def segment_worker(i_imname):
+    """
+    Reads the I-th UCM from ucm.mat, thresholds it and labels its segments.
+    Returns (imname, (mask,area,label)) with the uint16 mask, or
+    (imname, None) if it failed.
+    """
+    i,imname = i_imname
     try:
-        return (get_mask(ucm.T),imname)
+        ucm_h5 = _worker['ucm_h5']
+        ucm = ucm_h5[ucm_h5['ucms'][0,i]][:]
+        mask,area,label = get_mask((ucm > _worker['th']).astype('uint8').T)
+        return imname,(mask.astype('uint16'),area,label)
     except:
-        return None
-        #traceback.print_exc(file=sys.stdout)
+        traceback.print_exc(file=sys.stdout)
+        return imname,None
 
-def process_db_parallel(base_dir, th=0.11):
+def imap_bounded(pool,func,items,max_inflight,ordered=False):
+    """
+    Like pool.imap / pool.imap_unordered (if not ORDERED), but at most
+    MAX_INFLIGHT items are submitted and not yet consumed, so that
+    neither the inputs nor the results pile up when the consumer is slow.
+    """
+    results = queue.Queue()
+    inflight = collections.deque()
+    def submit(x):
+        if ordered:
+            inflight.append(pool.apply_async(func,(x,)))
+        else:
+            pool.apply_async(func,(x,),callback=results.put,error_callback=results.put)
+            inflight.append(None)
+
+    items = iter(items)
+    for x in itertools.islice(items,max_inflight):
+        submit(x)
+    while inflight:
+        res = inflight.popleft()
+        out = res.get() if ordered else results.get()
+        if isinstance(out,BaseException):
+            raise out
+        for x in itertools.islice(items,1):
+            submit(x)
+        yield out
+
+def write_mask(dbo_mask,imname,mask,area,label,compression='gzip'):
+    opts = {}
+    if compression == 'gzip':
+        opts = dict(compression='gzip',compression_opts=4,shuffle=True)
+    elif compression is not None:
+        opts = dict(compression=compression)
+    mask_dset = dbo_mask.create_dataset(imname,data=mask,chunks=mask.shape,**opts)
+    mask_dset.attrs['area'] = area
+    mask_dset.attrs['label'] = label
+
+def process_db_parallel(base_dir, th=0.11, out_path=None, nworkers=1,
+                        max_inflight=None, ordered=False, compression='gzip',
+                        restart=False):
     """
     Get segmentation masks from gPb contours.
+
+    Streams the UCMs in BASE_DIR/ucm.mat (output of run_ucm.m) through a
+    pool of NWORKERS processes, which read and segment them (UCM > TH), and
+    writes the masks as uint16 datasets (one chunk each, with the
+    attributes area and label) into the group "mask" of OUT_PATH
+    (BASE_DIR/seg_uint16.h5 by default), the layout add_more_data.py reads.
+    At most MAX_INFLIGHT (default 2*NWORKERS) images are in flight. The
+    masks are written in the order of ucm.mat if ORDERED, else as they
+    finish.
+    Resumable: the names of the written masks are appended to the manifest
+    OUT_PATH.done, and a re-run only segments the others (unless RESTART).
     """
     db_path = osp.join(base_dir,'ucm.mat')
-    out_path = osp.join(base_dir,'seg_uint16.h5')
-    # output h5 file:
-    dbo = h5py.File(out_path,'w')
-    dbo_mask = dbo.create_group("mask")
-
-    class ucm_iterable(object):
-        def __init__(self,ucm_path,th):
-            self.th = th
-            self.ucm_h5 = h5py.File(db_path,'r')
-            self.N = self.ucm_h5['names'].size
-            self.i = 0
-
-        def __iter__(self):
-            return self
-
-        def get_imname(self,i):
-            return "".join(map(chr, self.ucm_h5[self.ucm_h5['names'][0,self.i]][:]))
-
-        def __stop__(self):
-            print ("DONE")
-            self.ucm_h5.close()
-            raise StopIteration
-
-        def get_valid_name(self):
-            if self.i >= self.N:
-                self.__stop__()
-
-            imname = self.get_imname(self.i)
-            while self.i < self.N-1 and len(imname) < 4:
-                self.i += 1
-                imname = self.get_imname(self.i)
-
-            if len(imname) < 4:
-                self.__stop__()
-
-            return imname
-
-        def next(self):
-            imname = self.get_valid_name()
-            print ("%d of %d"%(self.i+1,self.N))
-            ucm = self.ucm_h5[self.ucm_h5['ucms'][0,self.i]][:]
-            ucm = ucm.copy()
-            self.i += 1
-            return ((ucm>self.th).astype('uint8'),imname)
-
-    ucm_iter = ucm_iterable(db_path,th)
-    print ("cpu count: ", mp.cpu_count())
-    parpool = mp.Pool(4)
-    ucm_result = parpool.imap_unordered(get_mask_parallel, ucm_iter, chunksize=1)
-
-    for res in ucm_result:
-        if res is None:
-            continue
-        ((mask,area,label),imname) = res
-        print ("got back : ", imname)
-        mask = mask.astype('uint16')
-        mask_dset = dbo_mask.create_dataset(imname, data=mask)
-        mask_dset.attrs['area'] = area
-        mask_dset.attrs['label'] = label
-
-    # close the h5 files:
-    print ("closing DB")
-    dbo.close()
+    if out_path is None:
+        out_path = osp.join(base_dir,'seg_uint16.h5')
+    if max_inflight is None:
+        max_inflight = 2*nworkers
+
+    manifest_path = out_path+'.done'
+    if restart or not osp.exists(out_path):
+        if osp.exists(manifest_path):
+            os.remove(manifest_path)
+    done = set()
+    if osp.exists(manifest_path):
+        with open(manifest_path,'r') as f:
+            done = set(l.strip() for l in f if l.strip())
+        print ("resuming: %d masks are already written"%len(done))
+
+    # output h5 file (a:append, w:write/overwrite):
+    dbo = h5py.File(out_path,'a' if done else 'w')
+    if "mask" not in dbo:
+        dbo.create_group("mask")
+    dbo_mask = dbo["mask"]
+    # remove the partially written masks of an interrupted run:
+    for imname in [n for n in dbo_mask.keys() if n not in done]:
+        del dbo_mask[imname]
+
+    # names of the images to segment (empty names are padding):
+    with h5py.File(db_path,'r') as ucm_h5:
+        N = ucm_h5['names'].size
+        todo = [(i,n) for i,n in ((i,read_imname(ucm_h5,i)) for i in range(N))
+                if len(n) >= 4 and n not in done]
+    print ("segmenting %d of %d images with %d workers"%(len(todo),N,nworkers))
+
+    failed = []
+    manifest = open(manifest_path,'a')
+    parpool = mp.Pool(nworkers,initializer=init_worker,initargs=(db_path,th))
+    try:
+        ucm_result = imap_bounded(parpool,segment_worker,todo,max_inflight,ordered)
+        for i,(imname,res) in enumerate(ucm_result):
+            if res is None:
+                failed.append(imname)
+                continue
+            mask,area,label = res
+            write_mask(dbo_mask,imname,mask,area,label,compression)
+            dbo.flush()
+            manifest.write(imname+'\n')
+            manifest.flush()
+            print ("%d of %d : %s"%(i+1,len(todo),imname))
+        parpool.close()
+    finally:
+        parpool.terminate()
+        parpool.join()
+        manifest.close()
+        # close the h5 files:
+        print ("closing DB")
+        dbo.close()
+
+    if failed:
+        print ("could not segment %d images: %s"%(len(failed),", ".join(sorted(failed))))
     print (">>>> DONE")
 
 
-base_dir = '/home/' # directory containing the ucm.mat, i.e., output of run_ucm.m
-process_db_parallel(base_dir)
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Segmentation masks from the gPb-UCM contours')
+    parser.add_argument('base_dir',help='directory containing the ucm.mat, i.e., output of run_ucm.m')
+    parser.add_argument('--th',type=float,default=0.11,help='UCM threshold of the contours')
+    parser.add_argument('--out',dest='out',default=None,help='output h5 file (default: BASE_DIR/seg_uint16.h5)')
+    parser.add_argument('--workers',type=int,dest='workers',default=mp.cpu_count(),help='number of worker processes')
+    parser.add_argument('--max-inflight',type=int,dest='max_inflight',default=None,help='max. number of images in flight (default: 2*workers)')
+    parser.add_argument('--ordered',action='store_true',default=False,help='write the masks in the order of ucm.mat')
+    parser.add_argument('--compression',choices=['none','gzip','lzf'],default='gzip',help='compression of the masks')
+    parser.add_argument('--restart',action='store_true',default=False,help='start over instead of resuming an interrupted run')
+    args = parser.parse_args()
+    compression = None if args.compression=='none' else args.compression
+    process_db_parallel(args.base_dir,args.th,args.out,args.workers,args.max_inflight,
+                        args.ordered,compression,args.restart)
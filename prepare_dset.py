@@ -0,0 +1,120 @@
+"""
+Convert the input dataset (dset_8000.h5, see add_more_data.py) to a run-ready
+dataset, which gen_more.py then uses instead (gen_more.READY_DB_FNAME):
+  - images are already resized to the resolution of the depth,
+  - depth is float16 and only holds the chosen channel (HxW),
+  - seg is uint16 (HxW), with the attributes area and label,
+each stored as a single chunk per image. Depth and seg are gzip-compressed
+(with the shuffle filter), images are not by default: natural images only
+shrink by ~1.3x, and decompressing them costs more than reading them.
+gen_more.load_scene reads these as they are, without decoding the second
+depth channel or resizing anything.
+Re-run this after changing the input dataset.
+"""
+
+import numpy as np
+import h5py
+import time
+import traceback
+import multiprocessing as mp
+from common import *
+import gen_more
+
+
+# per-process state of the conversion workers:
+_worker = {}
+
+def init_worker(db_fname,depth_channel):
+  _worker['db'] = h5py.File(db_fname,'r')
+  _worker['depth_channel'] = depth_channel
+
+def convert_worker(imname):
+  """
+  Returns (imname, (img,depth,seg,area,label)), the scene is None if
+  it could not be read.
+  """
+  try:
+    img,depth,seg,area,label = gen_more.load_scene(_worker['db'],imname,_worker['depth_channel'])
+    if seg.max() > np.iinfo('uint16').max:
+      raise Exception('too many segments for uint16: %d'%seg.max())
+    scene = (img, depth.astype('float16'), seg.astype('uint16'), area, label)
+  except:
+    traceback.print_exc()
+    scene = None
+  return imname,scene
+
+
+def write_scene(out_db,imname,scene,image_compression=None):
+  img,depth,seg,area,label = scene
+  out_db['image'].create_dataset(imname,data=img,chunks=img.shape,compression=image_compression)
+  for grp,data in (('depth',depth),('seg',seg)):
+    out_db[grp].create_dataset(imname,data=data,chunks=data.shape,
+                               compression='gzip',compression_opts=4,shuffle=True)
+  out_db['seg'][imname].attrs['area'] = area
+  out_db['seg'][imname].attrs['label'] = label
+
+def storage_size(db,imname):
+  return sum(db[grp][imname].id.get_storage_size() for grp in ('image','depth','seg'))
+
+def compare(in_fname,out_fname,imnames):
+  """
+  Prints the stored bytes and the load_scene time per image of both datasets.
+  """
+  for fname in (in_fname,out_fname):
+    with h5py.File(fname,'r') as db:
+      nbytes = np.mean([storage_size(db,n) for n in imnames])
+      t = time.time()
+      for n in imnames:
+        gen_more.load_scene(db,n)
+      t = (time.time()-t)/len(imnames)
+    print (colorize(Color.GREEN,'%s : %.1f KB, %.1f ms to load per image'%(fname,nbytes/1024,1e3*t)))
+
+
+def main(in_fname,out_fname,nworkers=1,depth_channel=1,image_compression=None,ncompare=20):
+  db = h5py.File(in_fname,'r')
+  if gen_more.is_ready_db(db):
+    print (colorize(Color.RED,'%s is already run-ready'%in_fname,bold=True))
+    return
+  # only the images with depth and segmentation can be used:
+  imnames = sorted(n for n in db['image'].keys() if n in db['depth'] and n in db['seg'])
+  db.close()
+
+  out_db = h5py.File(out_fname,'w')
+  out_db.attrs['format'] = 'ready'
+  out_db.attrs['depth_channel'] = depth_channel
+  for grp in ('image','depth','seg'):
+    out_db.create_group(grp)
+  print (colorize(Color.GREEN,'converting %d images, storing in: %s'%(len(imnames),out_fname), bold=True))
+
+  done = []
+  pool = mp.Pool(nworkers,initializer=init_worker,initargs=(in_fname,depth_channel))
+  try:
+    for i,(imname,scene) in enumerate(pool.imap_unordered(convert_worker,imnames,chunksize=4)):
+      if scene is None:
+        continue
+      write_scene(out_db,imname,scene,image_compression)
+      done.append(imname)
+      print (colorize(Color.BLUE,'%d of %d : %s'%(i,len(imnames)-1,imname)))
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
+    out_db.close()
+  print (colorize(Color.GREEN,'\t-> done',bold=True))
+
+  if ncompare > 0 and len(done) > 0:
+    compare(in_fname,out_fname,sorted(done)[:ncompare])
+
+
+if __name__=='__main__':
+  import argparse
+  parser = argparse.ArgumentParser(description='Convert the input dataset to a run-ready dataset')
+  parser.add_argument('--db',dest='db',default=gen_more.DB_FNAME,help='input dataset')
+  parser.add_argument('--out',dest='out',default=gen_more.READY_DB_FNAME,help='run-ready dataset')
+  parser.add_argument('--workers',type=int,dest='workers',default=mp.cpu_count(),help='number of worker processes')
+  parser.add_argument('--depth-channel',type=int,dest='depth_channel',default=1,help='depth channel to keep (0 or 1)')
+  parser.add_argument('--image-compression',choices=['none','gzip','lzf'],dest='image_compression',default='none',help='compression of the images')
+  parser.add_argument('--compare',type=int,dest='compare',default=20,help='number of images to compare the size and load time on (0 to skip)')
+  args = parser.parse_args()
+  image_compression = None if args.image_compression=='none' else args.image_compression
+  main(args.db,args.out,args.workers,args.depth_channel,image_compression,args.compare)
@@ -22,46 +22,101 @@ def fit_plane(xyz,z_pos=None):
             abcd *= -1
     return abcd
 
+def planes_from_moments(cov, mean, z_pos=None):
+    """
+    Batched version of the eigen-decomposition in fit_plane.
+    COV  : (m x 3 x 3) stack of scatter matrices of m point-sets
+    MEAN : (m x 3) means of the point-sets
+    Returns a (m x 4) array of plane coefficients.
+    """
+    l,v = np.linalg.eigh(cov)
+    abc = v[:,:,0] # eigenvalues are in ascending order
+    d = -np.sum(abc*mean,axis=1)
+    # unit-norm the plane-normals:
+    abcd = np.c_[abc,d]/np.linalg.norm(abc,axis=1)[:,None]
+    # flip the normal directions:
+    if z_pos is not None:
+        flip = abcd[:,:3].dot(z_pos) < 0.0
+        abcd[flip,:] *= -1
+    return abcd
+
+def fit_planes(xyz, z_pos=None):
+    """
+    Fits a plane to each of the m point-sets in XYZ (m x k x 3).
+    Returns a (m x 4) array of plane coefficients.
+    """
+    mean = np.mean(xyz,axis=1)
+    xyz_c = xyz - mean[:,None,:]
+    cov = np.einsum('mki,mkj->mij',xyz_c,xyz_c)
+    return planes_from_moments(cov,mean,z_pos)
+
 def fit_plane_ransac(pts, neighbors=None,z_pos=None, dist_inlier=0.05, 
-                     min_inlier_frac=0.60, nsample=3, max_iter=100):
+                     min_inlier_frac=0.60, nsample=3, max_iter=100,
+                     score_sample=None, early_stop=False, batch_size=25):
     """
     Fits a 3D plane model using RANSAC. 
     pts : (nx3 array) of point coordinates   
+
+    The hypotheses are fit and scored in batches of BATCH_SIZE.
+    score_sample : if not None, the hypotheses are scored and refit on a
+                   random subset of SCORE_SAMPLE points (if there are more).
+    early_stop : stop generating hypotheses after the first batch in
+                 which a hypothesis clears MIN_INLIER_FRAC.
     """
     n,_ = pts.shape
+    z_pos = None if z_pos is None else np.asarray(z_pos,'float')
+
+    # indices of the points of every hypothesis (max_iter x k):
+    if neighbors is None:
+        sample_idx = np.array([np.random.choice(n,nsample,replace=False)
+                               for i in range(max_iter)])
+    else:
+        sample_idx = neighbors[:,:max_iter].T
+
+    # points to score (and refit) the hypotheses on:
+    if score_sample is not None and score_sample < n:
+        score_pts = pts[np.random.randint(0,n,score_sample),:]
+    else:
+        score_pts = pts
+    nscore = score_pts.shape[0]
+    # center the points for numerically stable moments:
+    mu = np.mean(score_pts,axis=0)
+    score_pts = score_pts - mu[None,:]
+
     ninlier,models = [],[]
-    for i in range(max_iter):
-        if neighbors is None:
-            p = pts[np.random.choice(pts.shape[0],nsample,replace=False),:]
-        else:
-            p = pts[neighbors[:,i],:]
-        m = fit_plane(p,z_pos)
-        ds = np.abs(pts.dot(m[:3])+m[3])
-        nin = np.sum(ds < dist_inlier)
-        if nin/pts.shape[0] >= min_inlier_frac:
-            ninlier.append(nin)
-            models.append(m)
+    for b in range(0,len(sample_idx),batch_size):
+        m = fit_planes(pts[sample_idx[b:b+batch_size],:]-mu[None,None,:],z_pos)
+        ds = np.abs(score_pts.dot(m[:,:3].T) + m[:,3][None,:])
+        nin = np.sum(ds < dist_inlier,axis=0)
+        good = nin/nscore >= min_inlier_frac
+        ninlier.append(nin[good])
+        models.append(m[good,:])
+        if early_stop and np.any(good):
+            break
+    ninlier = np.concatenate(ninlier)
+    models = np.concatenate(models)
 
-    if models == []:
+    if len(models) == 0:
         print ("RANSAC plane fitting failed!")
         return #None
-    else: #refit the model to inliers:
-        ninlier = np.array(ninlier)
-        best_model_idx = np.argsort(-ninlier)
-        n_refit, m_refit, inliers = [],[],[]
-        for idx in best_model_idx[:min(10,len(best_model_idx))]:
-            # re-estimate the model based on inliers:
-            dists = np.abs(pts.dot(models[idx][:3])+models[idx][3])
-            inlier = dists < dist_inlier
-            m = fit_plane(pts[inlier,:],z_pos)
-            # compute new inliers:
-            d = np.abs(pts.dot(m[:3])+m[3])
-            inlier = d < dist_inlier/2 # heuristic
-            n_refit.append(np.sum(inlier))
-            m_refit.append(m)
-            inliers.append(inlier)
+    else: #refit the models to their inliers:
+        best_model_idx = np.argsort(-ninlier)[:10]
+        models = models[best_model_idx,:]
+        # re-estimate the models based on inliers:
+        w = (np.abs(score_pts.dot(models[:,:3].T)+models[:,3][None,:]) < dist_inlier).astype('float')
+        cnt = np.maximum(np.sum(w,axis=0),1)
+        mean = w.T.dot(score_pts)/cnt[:,None]
+        scatter = w.T.dot((score_pts[:,:,None]*score_pts[:,None,:]).reshape(nscore,9)).reshape(-1,3,3)
+        cov = scatter - cnt[:,None,None]*mean[:,:,None]*mean[:,None,:]
+        m_refit = planes_from_moments(cov,mean,z_pos)
+        # compute new inliers:
+        n_refit = np.sum(np.abs(score_pts.dot(m_refit[:,:3].T)+m_refit[:,3][None,:]) < dist_inlier/2, axis=0) # heuristic
         best_plane = np.argmax(n_refit)
-        return m_refit[best_plane],inliers[best_plane]
+        # move the plane back from the centered coordinates:
+        m = m_refit[best_plane,:].copy()
+        m[3] -= np.sum(m[:3]*mu)
+        inlier = np.abs(pts.dot(m[:3])+m[3]) < dist_inlier/2
+        return m,inlier
 
 
 
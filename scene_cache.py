@@ -0,0 +1,80 @@
+"""
+On-disk cache of the scene analysis of background images.
+
+The text-regions, their plane coefficients, placement masks and
+homographies (output of RendererV3.analyze_scene) do not depend on
+the text being rendered. They are stored per image in an h5 file, in
+a group keyed by the TextRegions parameters, so that changing the
+parameters never returns stale regions.
+"""
+
+import hashlib
+import numpy as np
+import h5py
+from synthgen import TextRegions, PLACE_MASK_PAD
+
+
+def params_key():
+    """
+    Returns a short hash of the parameters which the regions depend on.
+    """
+    params = sorted((k,v) for k,v in vars(TextRegions).items()
+                    if isinstance(v,(int,float)) and not k.startswith('_'))
+    params.append(('pad',PLACE_MASK_PAD))
+    return hashlib.sha1(repr(params).encode('utf-8')).hexdigest()[:12]
+
+
+class SceneCache(object):
+    """
+    Maps image names to the REGIONS dictionary of RendererV3.
+    """
+    def __init__(self, fname, mode='r'):
+        self.db = h5py.File(fname, mode)
+        self.key = 'regions_' + params_key()
+        if self.key in self.db:
+            self.group = self.db[self.key]
+        elif mode == 'r':
+            self.group = None
+        else:
+            self.group = self.db.create_group(self.key)
+
+    def __contains__(self, imname):
+        return self.group is not None and imname in self.group
+
+    def get(self, imname):
+        """
+        Returns the cached regions of IMNAME, or None if not cached.
+        """
+        if imname not in self:
+            return #None
+        g = self.group[imname]
+        n = g.attrs['nregions']
+        return {'label': list(g['label'][:]),
+                'coeff': list(g['coeff'][:]),
+                'rot': list(g['rot'][:]),
+                'area': list(g['area'][:]),
+                'place_mask': [g['place_mask_%d'%i][:] for i in range(n)],
+                'homography': list(g['homography'][:]),
+                'homography_inv': list(g['homography_inv'][:])}
+
+    def put(self, imname, regions):
+        """
+        Stores REGIONS (output of RendererV3.analyze_scene) for IMNAME.
+        """
+        if imname in self.group:
+            del self.group[imname]
+        g = self.group.create_group(imname)
+        n = len(regions['place_mask'])
+        g.attrs['nregions'] = n
+        g.create_dataset('label', data=np.array(regions['label']).reshape(n))
+        g.create_dataset('coeff', data=np.array(regions['coeff']).reshape((n,4)))
+        g.create_dataset('rot', data=np.array(regions['rot']).reshape((n,2,2)))
+        g.create_dataset('area', data=np.array(regions['area']).reshape(n))
+        g.create_dataset('homography', data=np.array(regions['homography']).reshape((n,3,3)))
+        g.create_dataset('homography_inv', data=np.array(regions['homography_inv']).reshape((n,3,3)))
+        for i in range(n):
+            g.create_dataset('place_mask_%d'%i, data=regions['place_mask'][i],
+                             compression='gzip')
+
+    def close(self):
+        self.db.close()
@@ -129,7 +129,8 @@ def ensure_proj_z(plane_coeffs, min_z_proj):
         return coeffs
     return plane_coeffs
 
-def isplanar(xyz,sample_neighbors,dist_thresh,num_inliers,z_proj):
+def isplanar(xyz,sample_neighbors,dist_thresh,num_inliers,z_proj,
+             score_sample=None,early_stop=False):
     """
     Checks if at-least FRAC_INLIERS fraction of points of XYZ (nx3)
     points lie on a plane. The plane is fit using RANSAC.
@@ -142,6 +143,7 @@ def isplanar(xyz,sample_neighbors,dist_thresh,num_inliers,z_proj):
     FRAC_INLIERS : fraction of total-points which should be inliers to
                    to declare that points are planar.
     Z_PROJ : changes the surface normal, so that its projection on z axis is ATLEAST z_proj.
+    SCORE_SAMPLE, EARLY_STOP : see ransac.fit_plane_ransac.
 
     Returns:
         None, if the data is not planar, else a 4-tuple of plane coeffs.
@@ -152,7 +154,8 @@ def isplanar(xyz,sample_neighbors,dist_thresh,num_inliers,z_proj):
     plane_info =  fit_plane_ransac(xyz,neighbors=sample_neighbors,
                             z_pos=dv,dist_inlier=dist_thresh,
                             min_inlier_frac=frac_inliers,nsample=20,
-                            max_iter=max_iter) 
+                            max_iter=max_iter,score_sample=score_sample,
+                            early_stop=early_stop) 
     if plane_info != None:
         coeff, inliers = plane_info
         coeff = ensure_proj_z(coeff, z_proj)
@@ -22,6 +22,51 @@ from colorize3_poisson import Colorize
 from common import *
 import traceback, itertools
 import time
+import random
+import multiprocessing as mp
+import signal
+
+# all the assignments of the 4 corners of a box (see RendererV3.char2wordBB):
+PERM4 = np.array(list(itertools.permutations(np.arange(4))))
+# pad of the placement masks (see RendererV3.filter_for_placement, part of
+# the scene-cache key):
+PLACE_MASK_PAD = 2
+
+class LabelIndex(object):
+    """
+    Index of the regions of a segmentation, built once per image.
+    Holds the bounding-box of every label, so that the per-label
+    masks can be computed on small crops (ROIs) instead of scanning
+    the whole image for every label.
+    """
+    def __init__(self, seg):
+        self.shape = seg.shape[:2]
+        self.seg = seg.astype('int32')
+        self.slices = sim.find_objects(self.seg)
+
+    def roi(self, l, pad=0):
+        """
+        Returns the (row,column) slices of the bounding-box of label L,
+        padded by PAD pixels and clipped to the image.
+        Returns None if L is not present in the segmentation.
+        """
+        l = int(l)
+        if l < 1 or l > len(self.slices) or self.slices[l-1] is None:
+            return #None
+        sy,sx = self.slices[l-1]
+        H,W = self.shape
+        return (slice(max(0,sy.start-pad), min(H,sy.stop+pad)),
+                slice(max(0,sx.start-pad), min(W,sx.stop+pad)))
+
+    def mask(self, l, pad=0):
+        """
+        Returns (mask,roi) : the binary mask of label L cropped to
+        its (padded) ROI, and the ROI. (None,None) if L is not present.
+        """
+        roi = self.roi(l,pad)
+        if roi is None:
+            return None,None
+        return self.seg[roi]==int(l), roi
 
 
 class TextRegions(object):
@@ -41,6 +86,9 @@ class TextRegions(object):
     num_inlier = 90
     ransac_fit_trials = 100
     min_z_projection = 0.25
+    # optional RANSAC speedups (change which plane is fit, off by default):
+    ransac_score_sample = None # no. of points to score the plane hypotheses on (None: all)
+    ransac_early_stop = False # stop at the first batch of good hypotheses
 
     minW = 20
 
@@ -65,17 +113,26 @@ class TextRegions(object):
         return h,w
  
     @staticmethod
-    def filter(seg,area,label):
+    def filter(seg,area,label,index=None):
         """
         Apply the filter.
         The final list is ranked by area.
+        INDEX : LabelIndex of SEG (built if None).
         """
+        if index is None:
+            index = LabelIndex(seg)
         good = label[area > TextRegions.minArea]
         area = area[area > TextRegions.minArea]
         filt,R = [],[]
         for idx,i in enumerate(good):
-            mask = seg==i
+            mask,roi = index.mask(i)
+            if mask is None: # region not present in the (resized) seg
+                filt.append(False)
+                R.append(None)
+                continue
             xs,ys = np.where(mask)
+            xs += roi[0].start
+            ys += roi[1].start
 
             coords = np.c_[xs,ys].astype('float32')
             rect = cv2.minAreaRect(coords)          
@@ -91,7 +148,7 @@ class TextRegions(object):
             R.append(rot)
 
         # filter bad regions:
-        filt = np.array(filt)
+        filt = np.array(filt,'bool')
         area = area[filt]
         R = [R[i] for i in range(len(R)) if filt[i]]
 
@@ -143,23 +200,30 @@ class TextRegions(object):
         return mask_nn_idx
 
     @staticmethod
-    def filter_depth(xyz,seg,regions):
+    def filter_depth(xyz,seg,regions,index=None):
+        if index is None:
+            index = LabelIndex(seg)
         plane_info = {'label':[],
                       'coeff':[],
                       'support':[],
                       'rot':[],
                       'area':[]}
         for idx,l in enumerate(regions['label']):
-            mask = seg==l
+            # pad the ROI by the neighbourhood size of sample_grid_neighbours:
+            mask,roi = index.mask(l,pad=6)
+            if mask is None:
+                continue
             pt_sample = TextRegions.sample_grid_neighbours(mask,TextRegions.ransac_fit_trials,step=3)
             if pt_sample is None:
                 continue #not enough points for RANSAC
             # get-depths
-            pt = xyz[mask]
+            pt = xyz[roi][mask]
             plane_model = su.isplanar(pt, pt_sample,
                                      TextRegions.dist_thresh,
                                      TextRegions.num_inlier,
-                                     TextRegions.min_z_projection)
+                                     TextRegions.min_z_projection,
+                                     TextRegions.ransac_score_sample,
+                                     TextRegions.ransac_early_stop)
             if plane_model is not None:
                 plane_coeff = plane_model[0]
                 if np.abs(plane_coeff[2])>TextRegions.min_z_projection:
@@ -172,10 +236,12 @@ class TextRegions(object):
         return plane_info
 
     @staticmethod
-    def get_regions(xyz,seg,area,label):
-        regions = TextRegions.filter(seg,area,label)
+    def get_regions(xyz,seg,area,label,index=None):
+        if index is None:
+            index = LabelIndex(seg)
+        regions = TextRegions.filter(seg,area,label,index)
         # fit plane to text-regions:
-        regions = TextRegions.filter_depth(xyz,seg,regions)
+        regions = TextRegions.filter_depth(xyz,seg,regions,index)
         return regions
 
 def rescale_frontoparallel(p_fp,box_fp,p_im):
@@ -206,7 +272,7 @@ def rescale_frontoparallel(p_fp,box_fp,p_im):
         s = 1.0
     return s
 
-def get_text_placement_mask(xyz,mask,plane,pad=2,viz=False):
+def get_text_placement_mask(xyz,mask,plane,pad=2,viz=False,roi=None):
     """
     Returns a binary mask in which text can be placed.
     Also returns a homography from original image
@@ -216,13 +282,17 @@ def get_text_placement_mask(xyz,mask,plane,pad=2,viz=False):
     MASK : (HxW) : non-zero pixels mark the object mask
     REGION : DICT output of TextRegions.get_regions
     PAD : number of pixels to pad the placement-mask by
+    ROI : (row,column) slices; if given MASK is the crop of the
+          object mask to this ROI (see LabelIndex.mask)
     """
+    offset = (0,0) if roi is None else (roi[1].start,roi[0].start)
     contour,hier = cv2.findContours(mask.copy().astype('uint8'),
                                     mode=cv2.RETR_CCOMP,
-                                    method=cv2.CHAIN_APPROX_SIMPLE)[-2:]
+                                    method=cv2.CHAIN_APPROX_SIMPLE,
+                                    offset=offset)[-2:]
     contour = [np.squeeze(c).astype('float') for c in contour]
     #plane = np.array([plane[1],plane[0],plane[2],plane[3]])
-    H,W = mask.shape[:2]
+    H,W = xyz.shape[:2]
 
     # bring the contour 3d points to fronto-parallel config:
     pts,pts_fp = [],[]
@@ -298,22 +368,27 @@ def viz_masks(fignum,rgb,seg,depth,label):
     img,depth,seg are images of the same size.
     visualizes depth masks for top NOBJ objects.
     """
+    index = LabelIndex(seg)
+
     def mean_seg(rgb,seg,label):
         mim = np.zeros_like(rgb)
         for i in np.unique(seg.flat):
-            mask = seg==i
-            col = np.mean(rgb[mask,:],axis=0)
-            mim[mask,:] = col[None,None,:]
-        mim[seg==0,:] = 0
+            mask,roi = index.mask(i)
+            if mask is None: # background
+                continue
+            col = np.mean(rgb[roi][mask,:],axis=0)
+            mim[roi][mask,:] = col[None,:]
         return mim
 
     mim = mean_seg(rgb,seg,label)
 
     img = rgb.copy()
     for i,idx in enumerate(label):
-        mask = seg==idx
+        mask,roi = index.mask(idx)
+        if mask is None:
+            continue
         rgb_rand = (255*np.random.rand(3)).astype('uint8')
-        img[mask] = rgb_rand[None,None,:] 
+        img[roi][mask] = rgb_rand[None,:] 
 
     #import scipy
     # scipy.misc.imsave('seg.png', mim)
@@ -367,19 +442,33 @@ def viz_textbb(fignum,text_im, bb_list,alpha=1.0):
     plt.gca().set_ylim([H-1,0])
     plt.show(block=False)
 
-class RendererV3(object):
+class SceneAnalyzer(object):
+    """
+    Text-independent analysis of the background images (text-regions,
+    planes, placement masks and homographies). Needs no fonts, corpus or
+    pygame, so that it is cheap to build (e.g. in precompute_scenes.py).
+    """
 
-    def __init__(self, data_dir, max_time=None):
-        self.text_renderer = tu.RenderFont(data_dir)
-        self.colorizer = Colorize(data_dir)
-        #self.colorizerV2 = colorV2.Colorize(data_dir)
+    def analyze_scene(self,depth,seg,area,label):
+        """
+        Text-independent analysis of the scene: finds the text-regions,
+        fits planes to them and computes the placement masks and
+        homographies. The arguments are as in render_text.
 
-        self.min_char_height = 8 #px
-        self.min_asp_ratio = 0.4 #
+        @return: the REGIONS dictionary consumed by render_instance.
+        """
+        # depth -> xyz
+        xyz = su.DepthCamera.depth2xyz(depth)
 
-        self.max_text_regions = 7
+        # index the regions of the segmentation:
+        index = LabelIndex(seg)
 
-        self.max_time = max_time
+        # find text-regions:
+        regions = TextRegions.get_regions(xyz,seg,area,label,index)
+
+        # find the placement mask and homographies:
+        regions = self.filter_for_placement(xyz,seg,regions,index)
+        return regions
 
     def filter_regions(self,regions,filt):
         """
@@ -390,11 +479,15 @@ class RendererV3(object):
             regions[k] = [regions[k][i] for i in idx]
         return regions
 
-    def filter_for_placement(self,xyz,seg,regions):
+    def filter_for_placement(self,xyz,seg,regions,index=None):
+        if index is None:
+            index = LabelIndex(seg)
         filt = np.zeros(len(regions['label'])).astype('bool')
         masks,Hs,Hinvs = [],[], []
         for idx,l in enumerate(regions['label']):
-            res = get_text_placement_mask(xyz,seg==l,regions['coeff'][idx],pad=2)
+            # pad the ROI to keep a background border around the contours:
+            mask,roi = index.mask(l,pad=PLACE_MASK_PAD)
+            res = get_text_placement_mask(xyz,mask,regions['coeff'][idx],pad=PLACE_MASK_PAD,roi=roi)
             if res is not None:
                 mask,H,Hinv = res
                 # check the homography matrix to avoid generating mirrored text
@@ -410,11 +503,6 @@ class RendererV3(object):
 
         return regions
 
-    def warpHomography(self,src_mat,H,dst_size):
-        dst_mat = cv2.warpPerspective(src_mat, H, dst_size,
-                                      flags=cv2.WARP_INVERSE_MAP|cv2.INTER_LINEAR)
-        return dst_mat
-
     def homographyBB(self, bbs, H, offset=None):
         """
         Apply homography transform to bounding-boxes.
@@ -462,6 +550,85 @@ class RendererV3(object):
             clockwise = True
         return clockwise
 
+class RendererV3(SceneAnalyzer):
+
+    def __init__(self, data_dir, max_time=None, instance_workers=1):
+        self.text_renderer = tu.RenderFont(data_dir)
+        self.colorizer = Colorize(data_dir)
+        #self.colorizerV2 = colorV2.Colorize(data_dir)
+
+        self.min_char_height = 8 #px
+        self.min_asp_ratio = 0.4 #
+
+        self.max_text_regions = 7
+
+        self.max_time = max_time
+
+        # number of processes rendering the instances of an image in parallel:
+        self.instance_workers = instance_workers
+        self.instance_pool = None
+        if instance_workers > 1:
+            self.instance_pool = self.make_instance_pool(instance_workers)
+
+    def make_instance_pool(self,nworkers):
+        """
+        Returns a pool of NWORKERS processes rendering instances with this
+        renderer, or None where fork is not available.
+        The workers are forked once, here, so that they share this renderer
+        with the parent process: create the renderer before starting any
+        threads (forking a process with live threads is unsafe).
+        """
+        try:
+            ctx = mp.get_context('fork')
+        except ValueError:
+            warn('fork is not available, rendering the instances serially')
+            return None
+        return ctx.Pool(nworkers, initializer=_init_instance_worker, initargs=(self,))
+
+    def close(self,terminate=False):
+        """
+        Shuts down the instance worker processes (if any).
+        """
+        if self.instance_pool is None:
+            return
+        if terminate:
+            self.instance_pool.terminate()
+        else:
+            self.instance_pool.close()
+        self.instance_pool.join()
+        self.instance_pool = None
+
+    def warpHomography(self,src_mat,H,dst_size):
+        dst_mat = cv2.warpPerspective(src_mat, H, dst_size,
+                                      flags=cv2.WARP_INVERSE_MAP|cv2.INTER_LINEAR)
+        return dst_mat
+
+    def warpHomographyROI(self, src_mat, H, Hinv, dst_size, pad=0):
+        """
+        Warps only the bounding-box of the non-zero pixels of SRC_MAT onto
+        the destination image of size DST_SIZE (W,H), see warpHomography.
+        The box of the warped rectangle is padded by PAD pixels and clipped
+        to the image.
+        Returns the warped ROI and its (x0,y0,x1,y1) in the destination
+        image, or (None,None) if it falls outside of it.
+        """
+        ys,xs = np.nonzero(src_mat)
+        if len(xs) == 0:
+            return None,None
+        corners = np.array([[xs.min(),xs.max()+1,xs.max()+1,xs.min()],
+                            [ys.min(),ys.min(),ys.max()+1,ys.max()+1]],'float')
+        corners = self.homographyBB(corners[:,:,None],Hinv)[:,:,0]
+        x0 = max(0, int(np.floor(corners[0].min()))-pad)
+        y0 = max(0, int(np.floor(corners[1].min()))-pad)
+        x1 = min(dst_size[0], int(np.ceil(corners[0].max()))+1+pad)
+        y1 = min(dst_size[1], int(np.ceil(corners[1].max()))+1+pad)
+        if x1 <= x0 or y1 <= y0:
+            return None,None
+        # ROI pixel (x,y) is the image pixel (x0+x,y0+y):
+        T = np.array([[1,0,x0],[0,1,y0],[0,0,1]],'float')
+        dst_mat = self.warpHomography(src_mat, H.dot(T), (x1-x0,y1-y0))
+        return dst_mat,(x0,y0,x1,y1)
+
     def bb_filter(self,bb0,bb,text):
         """
         Ensure that bounding-boxes are not too distorted
@@ -540,10 +707,12 @@ class RendererV3(object):
         # update the collision mask with text:
         collision_mask += (255 * (text_mask_dil>0)).astype('uint8')
 
-        # warp the object mask back onto the image:
-        text_mask_orig = text_mask.copy()
+        # warp the object mask back onto the image, only in the box around
+        # the text which feathering and colorizing (20px padding) touch:
         bb_orig = bb.copy()
-        text_mask = self.warpHomography(text_mask,H,rgb.shape[:2][::-1])
+        text_mask,roi = self.warpHomographyROI(text_mask,H,Hinv,rgb.shape[:2][::-1],pad=25)
+        if text_mask is None:
+            return #None
         bb = self.homographyBB(bb,Hinv)
 
         if not self.bb_filter(bb_orig,bb,text):
@@ -555,8 +724,12 @@ class RendererV3(object):
 
         #feathering:
         text_mask = self.feather(text_mask, min_h)
+        if not np.any(text_mask):
+            return #None
 
-        im_final = self.colorizer.color(rgb,[text_mask],np.array([min_h]))
+        x0,y0,x1,y1 = roi
+        im_final = rgb.copy()
+        im_final[y0:y1,x0:x1] = self.colorizer.color(rgb[y0:y1,x0:x1],[text_mask],np.array([min_h]))
 
         return im_final, text, bb, collision_mask
 
@@ -583,35 +756,33 @@ class RendererV3(object):
         """
         wrds = text.split()
         bb_idx = np.r_[0, np.cumsum([len(w) for w in wrds])]
-        wordBB = np.zeros((2,4,len(wrds)), 'float32')
-        
-        for i in range(len(wrds)):
-            cc = charBB[:,:,bb_idx[i]:bb_idx[i+1]]
-
-            # fit a rotated-rectangle:
-            # change shape from 2x4xn_i -> (4*n_i)x2
-            cc = np.squeeze(np.concatenate(np.dsplit(cc,cc.shape[-1]),axis=1)).T.astype('float32')
-            rect = cv2.minAreaRect(cc.copy())
-            box = np.array(cv2.boxPoints(rect))
-
-            # find the permutation of box-coordinates which
-            # are "aligned" appropriately with the character-bb.
-            # (exhaustive search over all possible assignments):
-            cc_tblr = np.c_[cc[0,:],
-                            cc[-3,:],
-                            cc[-2,:],
-                            cc[3,:]].T
-            perm4 = np.array(list(itertools.permutations(np.arange(4))))
-            dists = []
-            for pidx in range(perm4.shape[0]):
-                d = np.sum(np.linalg.norm(box[perm4[pidx],:]-cc_tblr,axis=1))
-                dists.append(d)
-            wordBB[:,:,i] = box[perm4[np.argmin(dists)],:].T
+        nwrd = len(wrds)
+
+        # corner points of the characters: (4*n)x2, character by character:
+        pts = charBB.transpose(2,1,0).reshape(-1,2).astype('float32')
+
+        # fit a rotated-rectangle to each word:
+        boxes = np.zeros((nwrd,4,2),'float32')
+        for i in range(nwrd):
+            rect = cv2.minAreaRect(pts[4*bb_idx[i]:4*bb_idx[i+1]].copy())
+            boxes[i] = cv2.boxPoints(rect)
+
+        # find the permutation of box-coordinates which
+        # are "aligned" appropriately with the character-bb
+        # (exhaustive search over all possible assignments, for all words at once);
+        # the reference corners are: top-left of the first char, top-right and
+        # bottom-right of the last char, bottom-left of the first char:
+        first, last = 4*bb_idx[:-1], 4*bb_idx[1:]-4
+        cc_tblr = np.stack([pts[first], pts[last+1], pts[last+2], pts[first+3]], axis=1)
+        perm_boxes = boxes[:,PERM4,:] # nwrd x 24 x 4 x 2
+        dists = np.sum(np.linalg.norm(perm_boxes-cc_tblr[:,None,:,:],axis=3),axis=2)
+        best = np.argmin(dists,axis=1) if nwrd > 0 else np.zeros(0,'int')
+        wordBB = perm_boxes[np.arange(nwrd),best].transpose(2,1,0).astype('float32')
 
         return wordBB
 
 
-    def render_text(self,rgb,depth,seg,area,label,ninstance=1,viz=False):
+    def render_text(self,rgb,depth,seg,area,label,ninstance=1,viz=False,regions=None):
         """
         rgb   : HxWx3 image rgb values (uint8)
         depth : HxW depth values (float)
@@ -622,6 +793,9 @@ class RendererV3(object):
                constitute a region mask
         ninstance : no of times image should be
                     used to place text.
+        regions : pre-computed output of analyze_scene (e.g. loaded
+                  from a SceneCache). If given, the scene analysis
+                  is skipped.
 
         @return:
             res : a list of dictionaries, one for each of 
@@ -637,91 +811,158 @@ class RendererV3(object):
             
             If there's an error in pre-text placement, for e.g. if there's 
             no suitable region for text placement, an empty list is returned.
+
+        If self.instance_workers > 1 (and VIZ is off), the instances
+        are rendered in parallel worker processes.
+        See render_text_iter to get the instances as they are rendered.
         """
-        try:
-            # depth -> xyz
-            xyz = su.DepthCamera.depth2xyz(depth)
-            
-            # find text-regions:
-            regions = TextRegions.get_regions(xyz,seg,area,label)
+        return list(self.render_text_iter(rgb,depth,seg,area,label,ninstance,viz,regions))
 
-            # find the placement mask and homographies:
-            regions = self.filter_for_placement(xyz,seg,regions)
+    def render_text_iter(self,rgb,depth,seg,area,label,ninstance=1,viz=False,regions=None):
+        """
+        Generator form of render_text (same arguments): yields the
+        dictionary of every instance as soon as it is rendered, so that
+        the caller can store it right away instead of holding all the
+        NINSTANCE images in memory. Yields nothing on failure.
+        """
+        try:
+            if regions is None:
+                regions = self.analyze_scene(depth,seg,area,label)
 
             # finally place some text:
             nregions = len(regions['place_mask'])
             if nregions < 1: # no good region to place text on
-                return []
+                return
         except:
             # failure in pre-text placement
             #import traceback
             traceback.print_exc()
-            return []
+            return
+
+        if self.instance_pool is not None and not viz:
+            yield from self.render_instances_parallel(rgb,regions,ninstance)
+            return
 
-        res = []
         for i in range(ninstance):
-            place_masks = copy.deepcopy(regions['place_mask'])
-
-            print (colorize(Color.CYAN, " ** instance # : %d"%i))
-
-            idict = {'img':[], 'charBB':None, 'wordBB':None, 'txt':None}
-
-            m = self.get_num_text_regions(nregions)#np.arange(nregions)#min(nregions, 5*ninstance*self.max_text_regions))
-            reg_idx = np.arange(min(2*m,nregions))
-            # deselect the random shuffle to use largest region first for placing text
-            np.random.shuffle(reg_idx)
-            reg_idx = reg_idx[:m]
-
-            placed = False
-            img = rgb.copy()
-            itext = []
-            ibb = []
-
-            # process regions: 
-            num_txt_regions = len(reg_idx)
-            NUM_REP = 3 # re-use each region three times:
-            reg_range = np.arange(NUM_REP * num_txt_regions) % num_txt_regions
-            for idx in reg_range:
-                ireg = reg_idx[idx]
-                try:
-                    if self.max_time is None:
-                        txt_render_res = self.place_text(img,place_masks[ireg],
-                                                         regions['homography'][ireg],
-                                                         regions['homography_inv'][ireg])
-                    else:
-                        with time_limit(self.max_time):
-                            #time.sleep(60)
-                            txt_render_res = self.place_text(img,place_masks[ireg],
-                                                             regions['homography'][ireg],
-                                                             regions['homography_inv'][ireg])
-                except TimeoutException as msg:
-                    print (msg)
-                    continue
-                except:
-                    traceback.print_exc()
-                    # some error in placing text on the region
-                    continue
-
-                if txt_render_res is not None:
-                    placed = True
-                    img,text,bb,collision_mask = txt_render_res
-                    # update the region collision mask:
-                    place_masks[ireg] = collision_mask
-                    # store the result:
-                    itext.append(text)
-                    ibb.append(bb)
-
-            if  placed:
-                # at least 1 word was placed in this instance:
-                idict['img'] = img
-                idict['txt'] = itext
-                idict['charBB'] = np.concatenate(ibb, axis=2)
-                idict['wordBB'] = self.char2wordBB(idict['charBB'].copy(), ' '.join(itext))
-                res.append(idict.copy())
+            idict = self.render_instance(rgb,regions,i)
+            if idict is not None:
+                yield idict
                 if viz:
-                    viz_textbb(1,img, [idict['wordBB']], alpha=1.0)
-                    viz_masks(2,img,seg,depth,regions['label'])
+                    viz_textbb(1,idict['img'], [idict['wordBB']], alpha=1.0)
+                    viz_masks(2,idict['img'],seg,depth,regions['label'])
                     # viz_regions(rgb.copy(),xyz,seg,regions['coeff'],regions['label'])
                     if i < ninstance-1:
                         input(colorize(Color.BLUE,'continue?',True))                    
-        return res
+
+    def render_instance(self,rgb,regions,i=0):
+        """
+        Renders a single instance of text onto RGB, using the
+        pre-computed REGIONS (output of filter_for_placement).
+        REGIONS is not modified.
+
+        @return: a dictionary as described in render_text, or
+                 None if no text could be placed.
+        """
+        nregions = len(regions['place_mask'])
+        place_masks = copy.deepcopy(regions['place_mask'])
+
+        print (colorize(Color.CYAN, " ** instance # : %d"%i))
+
+        idict = {'img':[], 'charBB':None, 'wordBB':None, 'txt':None}
+
+        m = self.get_num_text_regions(nregions)#np.arange(nregions)#min(nregions, 5*ninstance*self.max_text_regions))
+        reg_idx = np.arange(min(2*m,nregions))
+        # deselect the random shuffle to use largest region first for placing text
+        np.random.shuffle(reg_idx)
+        reg_idx = reg_idx[:m]
+
+        placed = False
+        img = rgb.copy()
+        itext = []
+        ibb = []
+
+        # process regions: 
+        num_txt_regions = len(reg_idx)
+        NUM_REP = 3 # re-use each region three times:
+        reg_range = np.arange(NUM_REP * num_txt_regions) % num_txt_regions
+        for idx in reg_range:
+            ireg = reg_idx[idx]
+            try:
+                if self.max_time is None:
+                    txt_render_res = self.place_text(img,place_masks[ireg],
+                                                     regions['homography'][ireg],
+                                                     regions['homography_inv'][ireg])
+                else:
+                    with time_limit(self.max_time):
+                        #time.sleep(60)
+                        txt_render_res = self.place_text(img,place_masks[ireg],
+                                                         regions['homography'][ireg],
+                                                         regions['homography_inv'][ireg])
+            except TimeoutException as msg:
+                print (msg)
+                continue
+            except:
+                traceback.print_exc()
+                # some error in placing text on the region
+                continue
+
+            if txt_render_res is not None:
+                placed = True
+                img,text,bb,collision_mask = txt_render_res
+                # update the region collision mask:
+                place_masks[ireg] = collision_mask
+                # store the result:
+                itext.append(text)
+                ibb.append(bb)
+
+        if not placed:
+            return #None
+
+        # at least 1 word was placed in this instance:
+        idict['img'] = img
+        idict['txt'] = itext
+        idict['charBB'] = np.concatenate(ibb, axis=2)
+        idict['wordBB'] = self.char2wordBB(idict['charBB'].copy(), ' '.join(itext))
+        return idict
+
+    def render_instances_parallel(self,rgb,regions,ninstance):
+        """
+        Renders NINSTANCE instances with the pool of self.instance_workers
+        processes and yields them (in order) as they come in.
+        Every worker gets one batch of the instances: a batch is sent as a
+        single pickle, in which RGB and the pre-computed REGIONS (shared by
+        all its tasks) are stored once, so they are copied once per worker
+        instead of once per instance.
+        On an error the pool is shut down, and the following images are
+        rendered serially.
+        """
+        chunksize = int(np.ceil(ninstance/self.instance_workers))
+        try:
+            for r in self.instance_pool.imap(_render_instance_worker,
+                                             ((rgb,regions,i) for i in range(ninstance)),
+                                             chunksize=max(chunksize,1)):
+                if r is not None:
+                    yield r
+        except GeneratorExit:
+            # the caller stopped early, the pending instances are dropped:
+            raise
+        except:
+            self.close(terminate=True)
+            raise
+
+
+# state of the instance worker processes:
+_instance_ctx = {}
+
+def _init_instance_worker(renderer):
+    # the workers inherit the SIGTERM handler installed by pygame/SDL,
+    # which would keep Pool.terminate from stopping them:
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # forked workers inherit the random state of the parent:
+    np.random.seed()
+    random.seed()
+    _instance_ctx['renderer'] = renderer
+
+def _render_instance_worker(args):
+    rgb,regions,i = args
+    return _instance_ctx['renderer'].render_instance(rgb,regions,i)
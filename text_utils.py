@@ -4,11 +4,11 @@ import matplotlib.pyplot as plt
 import scipy.io as sio
 import os.path as osp
 import random, os
+import mmap
 import cv2
 #import cPickle as cp
 import _pickle as cp
 import scipy.signal as ssig
-import scipy.stats as sstat
 import pygame, pygame.locals
 from pygame import freetype
 #import Image
@@ -16,6 +16,8 @@ from PIL import Image
 import math
 from common import *
 import pickle
+from collections import OrderedDict, Counter
+from param_sampler import get_sampler
 
 def sample_weighted(p_dict):
     ps = list(p_dict.keys())
@@ -29,6 +31,41 @@ def move_bb(bbs, t):
     """
     return bbs + t[:,None,None]
 
+def safe_locs_fft(back_arr, text_arr):
+    """
+    Exact collision search: returns a boolean map of the top-left
+    positions at which TEXT_ARR can be placed in BACK_ARR (255 for
+    unsafe, 0 for safe) without any text pixel hitting an unsafe pixel.
+    """
+    ba = np.clip(back_arr.copy().astype('float'), 0, 255)
+    ta = np.clip(text_arr.copy().astype('float'), 0, 255)
+    ba[ba > 127] = 1e8
+    intersect = ssig.fftconvolve(ba,ta[::-1,::-1],mode='valid')
+    return intersect < 1e8
+
+def safe_locs_sat(back_arr, text_arr):
+    """
+    Fast collision search using a summed-area table of the unsafe
+    pixels of BACK_ARR: a position is safe iff the bounding-box of
+    the text pixels in TEXT_ARR covers no unsafe pixel.
+    Conservative w.r.t. safe_locs_fft; same output format.
+    """
+    H,W = back_arr.shape[:2]
+    th,tw = text_arr.shape[:2]
+    ny,nx = H-th+1, W-tw+1
+    if ny < 1 or nx < 1:
+        return np.zeros((max(ny,0),max(nx,0)),'bool')
+    # bounding-box of the text pixels:
+    x0,y0,bw,bh = cv2.boundingRect((text_arr > 0).astype('uint8'))
+    if bw == 0 or bh == 0: # empty text
+        return np.ones((ny,nx),'bool')
+    S = cv2.integral((back_arr > 127).astype('uint8'))
+    S00 = S[y0:y0+ny, x0:x0+nx]
+    S01 = S[y0:y0+ny, x0+bw:x0+bw+nx]
+    S10 = S[y0+bh:y0+bh+ny, x0:x0+nx]
+    S11 = S[y0+bh:y0+bh+ny, x0+bw:x0+bw+nx]
+    return (S11 - S01 - S10 + S00) == 0
+
 def crop_safe(arr, rect, bbs=[], pad=0):
     """
     ARR : arr to crop
@@ -54,6 +91,69 @@ def crop_safe(arr, rect, bbs=[], pad=0):
         return arr
 
 
+class GlyphCache(object):
+    """
+    LRU cache of rasterized glyphs, keyed by the font file, size, style
+    and rotation. Text is composed by blitting the cached alpha bitmaps
+    with NumPy instead of calling freetype for every character.
+    The cache is bounded by the total size of the bitmaps (MAX_BYTES).
+    """
+    def __init__(self, max_bytes=64*1024*1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.glyphs = OrderedDict()
+
+    def get(self, font, ch, rotation=0):
+        """
+        Returns (alpha, metrics) of character CH rendered with FONT:
+            alpha   : wxh uint8 bitmap (pygame's x,y layout)
+            metrics : (x,y,w,h) : x is the offset of the bitmap from the
+                      origin, y the height of its top above the baseline.
+        """
+        key = (font.path, font.size, font.style, font.strength,
+               font.underline_adjustment, font.antialiased, ch, rotation)
+        glyph = self.glyphs.get(key)
+        if glyph is not None:
+            self.glyphs.move_to_end(key)
+            return glyph
+
+        surf,rect = font.render(ch, rotation=rotation)
+        glyph = (pygame.surfarray.array_alpha(surf), tuple(rect))
+        self.glyphs[key] = glyph
+        self.nbytes += glyph[0].nbytes
+        while self.nbytes > self.max_bytes and len(self.glyphs) > 1:
+            _,(alpha,_) = self.glyphs.popitem(last=False)
+            self.nbytes -= alpha.nbytes
+        return glyph
+
+    def get_rect(self, font, ch):
+        """
+        Cached equivalent of font.get_rect(CH) for a single character.
+        """
+        return pygame.Rect(self.get(font, ch)[1])
+
+    def render_to(self, canvas, dest, font, ch, rotation=0):
+        """
+        Blits character CH onto the uint8 alpha CANVAS (x,y layout) with
+        its origin at DEST (a point or a Rect), like font.render_to
+        with font.origin == True.
+        Returns the metrics Rect of the glyph (see get).
+        """
+        alpha,metrics = self.get(font, ch, rotation)
+        x0 = int(dest[0]) + metrics[0]
+        y0 = int(dest[1]) - metrics[1]
+        w,h = alpha.shape
+        # clip to the canvas:
+        cx0, cy0 = max(0,x0), max(0,y0)
+        cx1, cy1 = min(canvas.shape[0],x0+w), min(canvas.shape[1],y0+h)
+        if cx0 < cx1 and cy0 < cy1:
+            # alpha-composite over the canvas (overlapping glyphs):
+            dst = canvas[cx0:cx1,cy0:cy1]
+            src = alpha[cx0-x0:cx1-x0,cy0-y0:cy1-y0].astype('uint16')
+            dst[...] = src + dst - (src*dst + 127)//255
+        return pygame.Rect(metrics)
+
+
 class BaselineState(object):
     curve = lambda this, a: lambda x: a*x*x
     differential = lambda this, a: lambda x: 2*a*x
@@ -63,11 +163,12 @@ class BaselineState(object):
         """
         Returns the functions for the curve and differential for a and b
         """
+        S = get_sampler()
         sgn = 1.0
-        if np.random.rand() < 0.5:
+        if S.rand() < 0.5:
             sgn = -1
 
-        a = self.a[1]*np.random.randn() + sgn*self.a[0]
+        a = S.randn(sgn*self.a[0], self.a[1])
         return {
             'curve': self.curve(a),
             'diff': self.differential(a),
@@ -88,6 +189,9 @@ class RenderFont(object):
                        0.0 : 'PARA'}
 
         ## TEXT PLACEMENT PARAMETERS:
+        # collision search: 'fft' (exact text footprint) or 'sat' (bounding-box
+        # of the text with a summed-area table, falls back to 'fft'):
+        self.placement_engine = 'sat'
         self.f_shrink = 0.90
         self.max_shrink_trials = 5 # 0.9^5 ~= 0.6
         # the minimum number of characters that should fit in a mask
@@ -111,12 +215,15 @@ class RenderFont(object):
         # get font-state object:
         self.font_state = FontState(data_dir)
 
+        # cache of the rasterized glyphs:
+        self.glyph_cache = GlyphCache()
+
         pygame.init()
 
     def render_multiline(self,font,text):
         """
-        renders multiline TEXT on the pygame surface SURF with the
-        font style FONT.
+        renders multiline TEXT on an alpha canvas with the
+        font style FONT (glyphs come from self.glyph_cache).
         A new line in text is denoted by \n, no other characters are 
         escaped. Other forms of white-spaces should be converted to space.
 
@@ -132,10 +239,10 @@ class RenderFont(object):
         # initialize the surface to proper size:
         line_bounds = font.get_rect(lines[np.argmax(lengths)])
         fsize = (round(2.0*line_bounds.width), round(1.25*line_spacing*len(lines)))
-        surf = pygame.Surface(fsize, pygame.locals.SRCALPHA, 32)
+        surf = np.zeros(fsize,'uint8')
 
         bbs = []
-        space = font.get_rect('O')
+        space = self.glyph_cache.get_rect(font,'O')
         x, y = 0, 0
         for l in lines:
             x = 0 # carriage-return
@@ -146,7 +253,7 @@ class RenderFont(object):
                     x += space.width
                 else:
                     # render the character
-                    ch_bounds = font.render_to(surf, (x,y), ch)
+                    ch_bounds = self.glyph_cache.render_to(surf, (x,y), font, ch)
                     ch_bounds.x = x + ch_bounds.x
                     ch_bounds.y = y - ch_bounds.y
                     x += ch_bounds.width
@@ -161,7 +268,7 @@ class RenderFont(object):
 
         # crop the surface to fit the text:
         bbs = np.array(bbs)
-        surf_arr, bbs = crop_safe(pygame.surfarray.pixels_alpha(surf), rect_union, bbs, pad=5)
+        surf_arr, bbs = crop_safe(surf, rect_union, bbs, pad=5)
         surf_arr = surf_arr.swapaxes(0,1)
         #self.visualize_bb(surf_arr,bbs)
         return surf_arr, words, bbs
@@ -181,7 +288,8 @@ class RenderFont(object):
         lspace = font.get_sized_height() + 1
         lbound = font.get_rect(word_text)
         fsize = (round(2.0*lbound.width), round(3*lspace))
-        surf = pygame.Surface(fsize, pygame.locals.SRCALPHA, 32)
+        surf = np.zeros(fsize,'uint8')
+        surf_rect = pygame.Rect((0,0),fsize)
 
         # baseline state
         mid_idx = wl//2
@@ -192,11 +300,11 @@ class RenderFont(object):
 
         bbs = []
         # place middle char
-        rect = font.get_rect(word_text[mid_idx])
-        rect.centerx = surf.get_rect().centerx
-        rect.centery = surf.get_rect().centery + rect.height
+        rect = self.glyph_cache.get_rect(font, word_text[mid_idx])
+        rect.centerx = surf_rect.centerx
+        rect.centery = surf_rect.centery + rect.height
         rect.centery +=  curve[mid_idx]
-        ch_bounds = font.render_to(surf, rect, word_text[mid_idx], rotation=rots[mid_idx])
+        ch_bounds = self.glyph_cache.render_to(surf, rect, font, word_text[mid_idx], rotation=rots[mid_idx])
         ch_bounds.x = rect.x + ch_bounds.x
         ch_bounds.y = rect.y - ch_bounds.y
         mid_ch_bb = np.array(ch_bounds)
@@ -219,7 +327,7 @@ class RenderFont(object):
             ch_idx.append(i)
             ch = word_text[i]
 
-            newrect = font.get_rect(ch)
+            newrect = self.glyph_cache.get_rect(font, ch)
             newrect.y = last_rect.y
             if i > mid_idx:
                 newrect.topleft = (last_rect.topright[0]+2, newrect.topleft[1])
@@ -227,9 +335,9 @@ class RenderFont(object):
                 newrect.topright = (last_rect.topleft[0]-2, newrect.topleft[1])
             newrect.centery = max(newrect.height, min(fsize[1] - newrect.height, newrect.centery + curve[i]))
             try:
-                bbrect = font.render_to(surf, newrect, ch, rotation=rots[i])
+                bbrect = self.glyph_cache.render_to(surf, newrect, font, ch, rotation=rots[i])
             except ValueError:
-                bbrect = font.render_to(surf, newrect, ch)
+                bbrect = self.glyph_cache.render_to(surf, newrect, font, ch)
             bbrect.x = newrect.x + bbrect.x
             bbrect.y = newrect.y - bbrect.y
             bbs.append(np.array(bbrect))
@@ -247,7 +355,7 @@ class RenderFont(object):
 
         # crop the surface to fit the text:
         bbs = np.array(bbs)
-        surf_arr, bbs = crop_safe(pygame.surfarray.pixels_alpha(surf), rect_union, bbs, pad=5)
+        surf_arr, bbs = crop_safe(surf, rect_union, bbs, pad=5)
         surf_arr = surf_arr.swapaxes(0,1)
         return surf_arr, word_text, bbs
 
@@ -269,11 +377,7 @@ class RenderFont(object):
         locs = [None for i in range(len(text_arrs))]
         out_arr = np.zeros_like(back_arr)
         for i in order:            
-            ba = np.clip(back_arr.copy().astype(np.float), 0, 255)
-            ta = np.clip(text_arrs[i].copy().astype(np.float), 0, 255)
-            ba[ba > 127] = 1e8
-            intersect = ssig.fftconvolve(ba,ta[::-1,::-1],mode='valid')
-            safemask = intersect < 1e8
+            safemask = self.find_safe_locs(back_arr,text_arrs[i])
 
             if not np.any(safemask): # no collision-free position:
                 #warn("COLLISION!!!")
@@ -292,6 +396,18 @@ class RenderFont(object):
 
         return out_arr, locs, bbs, order
 
+    def find_safe_locs(self, back_arr, text_arr):
+        """
+        Returns a boolean map of the collision-free top-left positions
+        of TEXT_ARR in BACK_ARR, using self.placement_engine.
+        """
+        if self.placement_engine == 'sat':
+            safemask = safe_locs_sat(back_arr,text_arr)
+            if np.any(safemask):
+                return safemask
+        # exact footprint:
+        return safe_locs_fft(back_arr,text_arr)
+
     def robust_HW(self,mask):
         m = mask.copy()
         m = (~mask).astype('float')/255
@@ -300,10 +416,11 @@ class RenderFont(object):
         return rH,rW
 
     def sample_font_height_px(self,h_min,h_max):
-        if np.random.rand() < self.p_flat:
-            rnd = np.random.rand()
+        S = get_sampler()
+        if S.rand() < self.p_flat:
+            rnd = S.rand()
         else:
-            rnd = np.random.beta(2.0,2.0)
+            rnd = S.beta(2.0,2.0)
 
         h_range = h_max - h_min
         f_h = np.floor(h_min + h_range*rnd)
@@ -415,6 +532,14 @@ class FontState(object):
     curved = 0.2
     random_kerning = 0.2
     random_kerning_amount = 0.1
+    min_glyph_coverage = 0.0 # drop fonts missing more of the char-model (needs the metrics table)
+    use_font_aspect_ratio = False # use the real per-font aspect ratio (needs the metrics table), else 1.0
+
+    # per-font metrics table written by build_font_metrics.py:
+    METRICS_DTYPE = np.dtype([('font', 'U128'),        # path relative to data/fonts
+                              ('aspect_ratio', 'f4'),  # weighted mean width/height
+                              ('coverage', 'f4'),      # char-model mass with a glyph
+                              ('px2pt', 'f8', (2,))])  # linear model: px -> pt
 
     def __init__(self, data_dir='data'):
 
@@ -441,37 +566,77 @@ class FontState(object):
         self.FONT_LIST = osp.join(data_dir, 'fonts/fontlist.txt')
         self.fonts = [os.path.join(data_dir,'fonts',f.strip()) for f in open(self.FONT_LIST)]
 
+        # precomputed per-font metrics (optional), memory-mapped:
+        self.METRICS_PATH = osp.join(data_dir, 'models/font_metrics.npy')
+        self.font_metrics, self.font_metrics_idx = None, {}
+        if osp.exists(self.METRICS_PATH):
+            self.font_metrics = np.load(self.METRICS_PATH, mmap_mode='r')
+            self.font_metrics_idx = {osp.join(data_dir,'fonts',f):i
+                                     for i,f in enumerate(self.font_metrics['font'])}
+            if self.min_glyph_coverage > 0:
+                self.fonts = [f for f in self.fonts if f not in self.font_metrics_idx or
+                              self.font_metrics['coverage'][self.font_metrics_idx[f]] >= self.min_glyph_coverage]
+
+        # pool of opened fonts, keyed by the font path (see get_font):
+        self.max_open_fonts = 256
+        self.font_pool = OrderedDict()
+        self.font_pool_pid = os.getpid()
+
 
     def get_aspect_ratio(self, font, size=None):
         """
         Returns the median aspect ratio of each character of the font.
+        1.0 unless use_font_aspect_ratio is set: the previous per-call
+        computation always failed over to 1.0 (on indexing dict.values()),
+        and the real ratios (~0.5-0.6) change the sampled font heights and
+        number of characters per line. If set, the ratio is looked up in
+        the font-metrics table (1.0 for fonts which are not in there).
+        """
+        i = self.font_metrics_idx.get(font.path)
+        if self.use_font_aspect_ratio and i is not None:
+            return float(self.font_metrics['aspect_ratio'][i])
+        return 1.0
+
+    def compute_aspect_ratio(self, font, size=None):
+        """
+        Returns the frequency-weighted mean aspect ratio (width/height) of
+        the characters of the char-model in FONT, and the fraction of the
+        char-model (by frequency) for which the font has a glyph.
         """
         if size is None:
             size = 12 # doesn't matter as we take the RATIO
         chars = ''.join(self.char_freq.keys())
-        w = np.array(self.char_freq.values())
+        w = np.array(list(self.char_freq.values()), 'float')
 
         # get the [height,width] of each character:
         try:
             sizes = font.get_metrics(chars,size)
             good_idx = [i for i in range(len(sizes)) if sizes[i] is not None]
+            coverage = np.sum(w[good_idx]) / np.sum(w)
             sizes,w = [sizes[i] for i in good_idx], w[good_idx]
             sizes = np.array(sizes).astype('float')[:,[3,4]]        
-            r = np.abs(sizes[:,1]/sizes[:,0]) # width/height
+            with np.errstate(divide='ignore', invalid='ignore'):
+                r = np.abs(sizes[:,1]/sizes[:,0]) # width/height
             good = np.isfinite(r)
             r = r[good]
             w = w[good]
             w /= np.sum(w)
             r_avg = np.sum(w*r)
-            return r_avg
+            if not np.isfinite(r_avg):
+                return 1.0, coverage
+            return r_avg, coverage
         except:
-            return 1.0
+            return 1.0, 0.0
 
     def get_font_size(self, font, font_size_px):
         """
         Returns the font-size which corresponds to FONT_SIZE_PX pixels font height.
         """
-        m = self.font_model[font.name]
+        i = self.font_metrics_idx.get(font.path)
+        if i is not None:
+            m = self.font_metrics['px2pt'][i]
+        else:
+            m = self.font_model[font.name]
         return m[0]*font_size_px + m[1] #linear model
 
 
@@ -479,29 +644,55 @@ class FontState(object):
         """
         Samples from the font state distribution
         """
+        S = get_sampler()
         return {
-            'font': self.fonts[int(np.random.randint(0, len(self.fonts)))],
-            'size': self.size[1]*np.random.randn() + self.size[0],
-            'underline': np.random.rand() < self.underline,
-            'underline_adjustment': max(2.0, min(-2.0, self.underline_adjustment[1]*np.random.randn() + self.underline_adjustment[0])),
-            'strong': np.random.rand() < self.strong,
-            'oblique': np.random.rand() < self.oblique,
-            'strength': (self.strength[1] - self.strength[0])*np.random.rand() + self.strength[0],
-            'char_spacing': int(self.kerning[3]*(np.random.beta(self.kerning[0], self.kerning[1])) + self.kerning[2]),
-            'border': np.random.rand() < self.border,
-            'random_caps': np.random.rand() < self.random_caps,
-            'capsmode': random.choice(self.capsmode),
-            'curved': np.random.rand() < self.curved,
-            'random_kerning': np.random.rand() < self.random_kerning,
+            'font': self.fonts[S.randint(len(self.fonts))],
+            'size': S.randn(self.size[0], self.size[1]),
+            'underline': S.rand() < self.underline,
+            'underline_adjustment': max(2.0, min(-2.0, S.randn(self.underline_adjustment[0], self.underline_adjustment[1]))),
+            'strong': S.rand() < self.strong,
+            'oblique': S.rand() < self.oblique,
+            'strength': (self.strength[1] - self.strength[0])*S.rand() + self.strength[0],
+            'char_spacing': int(self.kerning[3]*S.beta(self.kerning[0], self.kerning[1]) + self.kerning[2]),
+            'border': S.rand() < self.border,
+            'random_caps': S.rand() < self.random_caps,
+            'capsmode': S.choice(self.capsmode),
+            'curved': S.rand() < self.curved,
+            'random_kerning': S.rand() < self.random_kerning,
             'random_kerning_amount': self.random_kerning_amount,
         }
 
+    def get_font(self, path):
+        """
+        Returns the pygame font of the font file PATH from the pool of
+        opened fonts (LRU, at most self.max_open_fonts fonts).
+        The pool is per process: fonts opened before a fork are not
+        shared with the child, as they read from the font files lazily.
+        """
+        if self.font_pool_pid != os.getpid():
+            self.font_pool = OrderedDict()
+            self.font_pool_pid = os.getpid()
+
+        font = self.font_pool.get(path)
+        if font is not None:
+            self.font_pool.move_to_end(path)
+            return font
+
+        font = freetype.Font(path)
+        self.font_pool[path] = font
+        while len(self.font_pool) > self.max_open_fonts:
+            self.font_pool.popitem(last=False)
+        return font
+
     def init_font(self,fs):
         """
         Initializes a pygame font.
         FS : font-state sample
+        The font object comes from the font pool, all of its style
+        attributes are reset from FS.
         """
-        font = freetype.Font(fs['font'], size=fs['size'])
+        font = self.get_font(fs['font'])
+        font.size = fs['size']
         font.underline = fs['underline']
         font.underline_adjustment = fs['underline_adjustment']
         font.strong = fs['strong']
@@ -513,21 +704,251 @@ class FontState(object):
         return font
 
 
+class MappedCorpus(object):
+    """
+    Read-only list of text lines backed by a memory-mapped corpus:
+      <prefix>.blob        : UTF-8 text, the stripped lines each followed by a new-line
+      <prefix>.offsets.npy : uint64 byte offsets of the lines into the blob (n+1 long)
+    Only the lines which are accessed are decoded, and all the processes
+    reading the same corpus share its pages through the OS page cache.
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.offsets = np.load(prefix+'.offsets.npy', mmap_mode='r')
+        with open(prefix+'.blob','rb') as f:
+            if osp.getsize(prefix+'.blob') > 0:
+                self.blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.blob = b''
+
+    @staticmethod
+    def exists(prefix):
+        return osp.exists(prefix+'.blob') and osp.exists(prefix+'.offsets.npy')
+
+    @staticmethod
+    def build(txt_fn, prefix):
+        """
+        Converts the text file TXT_FN (one sentence per line) to the
+        corpus at PREFIX. Returns the number of lines.
+        """
+        with open(txt_fn,'r',encoding='utf-8') as fin:
+            return MappedCorpus.write((l.strip() for l in fin), prefix)
+
+    @staticmethod
+    def write(lines, prefix):
+        """
+        Writes the iterable of LINES (without new-lines) to the corpus at
+        PREFIX. Returns the number of lines.
+        """
+        offsets = [0]
+        with open(prefix+'.blob','wb') as fout:
+            for l in lines:
+                b = (l+'\n').encode('utf-8')
+                fout.write(b)
+                offsets.append(offsets[-1]+len(b))
+        np.save(prefix+'.offsets.npy', np.array(offsets,'uint64'))
+        return len(offsets)-1
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('corpus line index out of range')
+        s,e = int(self.offsets[i]), int(self.offsets[i+1])
+        return self.blob[s:e-1].decode('utf-8') # drop the new-line
+
+
+class WordIndex(object):
+    """
+    Index of the distinct valid words of a corpus for TextSource.sample_word:
+      <prefix>.blob/.offsets.npy : the words (a MappedCorpus), sorted by length
+      <prefix>.cumfreq.npy       : cumulative corpus counts of the sorted words
+      <prefix>.nchar.npy         : nchar[L] = index of the first word with length >= L
+    A word with min_len <= len <= max_len is drawn with its corpus frequency
+    by a single random number and a binary search of the cumulative counts.
+    """
+    def __init__(self, prefix):
+        self.words = MappedCorpus(prefix)
+        self.cumfreq = np.load(prefix+'.cumfreq.npy', mmap_mode='r')
+        self.nchar = np.load(prefix+'.nchar.npy')
+
+    @staticmethod
+    def exists(prefix):
+        return MappedCorpus.exists(prefix) and osp.exists(prefix+'.cumfreq.npy')
+
+    @staticmethod
+    def build(lines, prefix, is_good):
+        """
+        Counts the words of LINES (an iterable of text lines), keeps those
+        for which IS_GOOD(word) is true and writes the index at PREFIX.
+        Returns the number of distinct words.
+        """
+        counts = Counter()
+        for l in lines:
+            counts.update(l.split())
+        words = sorted((w for w in counts if is_good(w)), key=lambda w: (len(w),w))
+        MappedCorpus.write(words, prefix)
+        np.save(prefix+'.cumfreq.npy', np.cumsum([counts[w] for w in words], dtype='uint64'))
+        lens = np.array([len(w) for w in words], 'int64')
+        max_len = lens[-1] if len(lens) else 0
+        np.save(prefix+'.nchar.npy', np.searchsorted(lens, np.arange(max_len+2)).astype('int64'))
+        return len(words)
+
+    def sample(self, min_len, max_len):
+        """
+        Returns a random word with MIN_LEN <= length <= MAX_LEN (weighted
+        by corpus frequency), or None if there is no such word.
+        """
+        n = len(self.nchar)-1
+        i0 = self.nchar[int(np.clip(min_len,0,n))]
+        i1 = self.nchar[int(np.clip(max_len+1,0,n))]
+        if i1 <= i0:
+            return None
+        lo = int(self.cumfreq[i0-1]) if i0 > 0 else 0
+        hi = int(self.cumfreq[i1-1])
+        r = lo + get_sampler().randint(hi-lo)
+        i = int(np.searchsorted(self.cumfreq[i0:i1], r, side='right')) + i0
+        return self.words[i]
+
+
+class SegmentIndex(object):
+    """
+    Per-line and per-word statistics of a corpus for TextSource.get_lines:
+      <prefix>.lines.npy : for every line: index of its first word (n+1 long),
+                           number of characters and of symbols, all-excluded flag
+      <prefix>.words.npy : for every word (in corpus order): number of
+                           characters and of symbols, all-excluded flag
+    Symbols are the non-alphanumeric characters, the all-excluded flag is set if
+    every character is in TextSource.char_ex. With these, the validity of runs of
+    lines and of word spans trimmed to a maximum length is checked with array
+    lookups for a whole batch of random candidates at once.
+    """
+    LINE_DTYPE = np.dtype([('word0','u8'),('nchar','u4'),('nsym','u4'),('excl','u1')])
+    WORD_DTYPE = np.dtype([('nchar','u2'),('nsym','u2'),('excl','u1')])
+
+    def __init__(self, prefix):
+        self.lines = np.load(prefix+'.lines.npy', mmap_mode='r')
+        self.words = np.load(prefix+'.words.npy', mmap_mode='r')
+
+    @staticmethod
+    def exists(prefix):
+        return osp.exists(prefix+'.lines.npy') and osp.exists(prefix+'.words.npy')
+
+    @staticmethod
+    def build(lines, prefix, char_ex):
+        """
+        Writes the index of LINES (a sequence of text lines) at PREFIX.
+        Returns the number of words.
+        """
+        def stats(t):
+            return len(t), sum(not ch.isalnum() for ch in t), all(ch in char_ex for ch in t)
+
+        line_tab = np.zeros(len(lines)+1, SegmentIndex.LINE_DTYPE)
+        word_stats, word_cache = [], {}
+        for i,l in enumerate(lines):
+            line_tab[i] = (len(word_stats),) + stats(l)
+            for w in l.split():
+                if w not in word_cache:
+                    nch,nsym,excl = stats(w)
+                    word_cache[w] = (min(nch,2**16-1), min(nsym,2**16-1), excl)
+                word_stats.append(word_cache[w])
+        line_tab[-1]['word0'] = len(word_stats)
+        np.save(prefix+'.lines.npy', line_tab)
+        np.save(prefix+'.words.npy', np.array(word_stats, SegmentIndex.WORD_DTYPE))
+        return len(word_stats)
+
+    def sample(self, nline, nword, nchar_max, min_nchar, f=0.35, nsample=100):
+        """
+        Draws NSAMPLE random runs of NLINE consecutive lines, and in every
+        line a random span of NWORD[i] consecutive words, trimmed from the end
+        to at most NCHAR_MAX characters (as in TextSource.get_lines).
+        Returns the (line-index, first-word, number-of-words) of the NLINE
+        spans of the first candidate for which all lines and spans are valid,
+        or None if none is.
+        """
+        n = len(self.lines)-1
+        if n <= nline:
+            return None
+        kmax = max(nword)
+        rng = get_sampler().rng
+        starts = rng.integers(0, n-nline, size=nsample)
+        li = starts[:,None] + np.arange(nline)[None,:] # candidate x line
+
+        # the lines must be valid:
+        lt = self.lines[li.ravel()]
+        nch, nsym = lt['nchar'].astype('int64'), lt['nsym'].astype('int64')
+        ok = (nch > min_nchar) & (nsym <= f*nch) & (lt['excl'] == 0)
+        ok = ok.reshape(li.shape).all(axis=1)
+        if not np.any(ok):
+            return None
+        li = li[ok]
+
+        # random span of nword[i] words in every line:
+        w0 = self.lines['word0'][li].astype('int64')
+        nw = self.lines['word0'][li+1].astype('int64') - w0
+        k = np.minimum(np.array(nword,'int64')[None,:], nw)
+        first = w0 + np.floor(rng.random(nw.shape)*(np.maximum(nw-k,0)+1)).astype('int64')
+
+        # stats of the prefixes of the spans (words joined by a space):
+        j = np.arange(kmax)[None,None,:]
+        valid_w = j < k[:,:,None]
+        wt = self.words[np.where(valid_w, first[:,:,None]+j, 0)]
+        pref_nch = np.cumsum(np.where(valid_w, wt['nchar'], 0), axis=2) + j
+        pref_nsym = np.cumsum(np.where(valid_w, wt['nsym'], 0), axis=2) + j
+
+        # trim to nchar_max: keep the longest prefix which fits:
+        fits = valid_w & (pref_nch <= nchar_max)
+        m = np.sum(fits, axis=2) # number of words kept (prefix lengths are increasing)
+        mi = np.maximum(m-1,0)[:,:,None]
+        seg_nch = np.take_along_axis(pref_nch, mi, axis=2)[:,:,0]
+        seg_nsym = np.take_along_axis(pref_nsym, mi, axis=2)[:,:,0]
+        seg_excl = (m == 1) & (wt['excl'][:,:,0] != 0)
+        seg_ok = (m > 0) & (seg_nch > min_nchar) & (seg_nsym <= f*seg_nch) & ~seg_excl
+
+        good = np.flatnonzero(seg_ok.all(axis=1))
+        if len(good) == 0:
+            return None
+        c = good[0]
+        return [(int(li[c,i]), int(first[c,i]-w0[c,i]), int(m[c,i])) for i in range(nline)]
+
+
 class TextSource(object):
     """
     Provides text for words, paragraphs, sentences.
     """
+    char_ex = ['i','I','o','O','0','-'] # a text only made of these is not valid
+
     def __init__(self, min_nchar, fn):
         """
         TXT_FN : path to file containing text data.
+                 If the memory-mapped corpus of this file exists (same path
+                 without the extension, see build_corpus.py), it is used
+                 instead of reading the text file into memory.
         """
         self.min_nchar = min_nchar
         self.fdict = {'WORD':self.sample_word,
                       'LINE':self.sample_line,
                       'PARA':self.sample_para}
 
-        with open(fn,'r', encoding='utf-8') as f:
-            self.txt = [l.strip() for l in f.readlines()]
+        corpus_prefix = osp.splitext(fn)[0]
+        if MappedCorpus.exists(corpus_prefix):
+            self.txt = MappedCorpus(corpus_prefix)
+        else:
+            with open(fn,'r', encoding='utf-8') as f:
+                self.txt = [l.strip() for l in f.readlines()]
+
+        # length-bucketed index of the valid words (optional, see build_corpus.py):
+        self.word_index = None
+        if WordIndex.exists(corpus_prefix+'.words'):
+            self.word_index = WordIndex(corpus_prefix+'.words')
+
+        # statistics of the lines and words for get_lines (optional, see build_corpus.py):
+        self.segment_index = None
+        if SegmentIndex.exists(corpus_prefix+'.segments'):
+            self.segment_index = SegmentIndex(corpus_prefix+'.segments')
 
         # distribution over line/words for LINE/PARA:
         self.p_line_nline = np.array([0.85, 0.10, 0.05])
@@ -557,8 +978,7 @@ class TextSource(object):
                          4. Not all characters are i,x,0,O,-
         """
         def is_txt(l):
-            char_ex = ['i','I','o','O','0','-']
-            chs = [ch in char_ex for ch in l]
+            chs = [ch in self.char_ex for ch in l]
             return not np.all(chs)
 
         return [ (len(l)> self.min_nchar
@@ -581,6 +1001,9 @@ class TextSource(object):
         return lines
 
     def get_lines(self, nline, nword, nchar_max, f=0.35, niter=100):
+        if self.segment_index is not None:
+            return self.get_lines_indexed(nline, nword, nchar_max, f, niter)
+
         def h_lines(niter=100):
             lines = ['']
             iter = 0
@@ -615,10 +1038,26 @@ class TextSource(object):
         else:
             return lines
 
+    def get_lines_indexed(self, nline, nword, nchar_max, f=0.35, niter=100):
+        """
+        get_lines using self.segment_index: every iteration checks a batch of
+        random candidates with array lookups, only the lines of the chosen
+        candidate are decoded.
+        """
+        for _ in range(niter):
+            spans = self.segment_index.sample(nline, nword, nchar_max, self.min_nchar, f)
+            if spans is not None:
+                return [' '.join(self.txt[l].split()[w:w+m]) for l,w,m in spans]
+        return #None
+
     def sample(self, nline_max,nchar_max,kind='WORD'):
         return self.fdict[kind](nline_max,nchar_max)
         
     def sample_word(self,nline_max,nchar_max,niter=100):
+        if self.word_index is not None:
+            rand_word = self.word_index.sample(self.min_nchar+1, nchar_max)
+            return [] if rand_word is None else rand_word
+
         rand_line = self.txt[np.random.choice(len(self.txt))]                
         words = rand_line.split()
         rand_word = random.choice(words)
@@ -637,12 +1076,13 @@ class TextSource(object):
 
 
     def sample_line(self,nline_max,nchar_max):
+        S = get_sampler()
         nline = nline_max+1
         while nline > nline_max:
-            nline = np.random.choice([1,2,3], p=self.p_line_nline)
+            nline = S.choice([1,2,3], p=self.p_line_nline)
 
         # get number of words:
-        nword = [self.p_line_nword[2]*sstat.beta.rvs(a=self.p_line_nword[0], b=self.p_line_nword[1])
+        nword = [self.p_line_nword[2]*S.beta(self.p_line_nword[0], self.p_line_nword[1])
                  for _ in range(nline)]
         nword = [max(1,int(np.ceil(n))) for n in nword]
 
@@ -653,19 +1093,20 @@ class TextSource(object):
             return []
 
     def sample_para(self,nline_max,nchar_max):
+        S = get_sampler()
         # get number of lines in the paragraph:
-        nline = nline_max*sstat.beta.rvs(a=self.p_para_nline[0], b=self.p_para_nline[1])
+        nline = nline_max*S.beta(self.p_para_nline[0], self.p_para_nline[1])
         nline = max(1, int(np.ceil(nline)))
 
         # get number of words:
-        nword = [self.p_para_nword[2]*sstat.beta.rvs(a=self.p_para_nword[0], b=self.p_para_nword[1])
+        nword = [self.p_para_nword[2]*S.beta(self.p_para_nword[0], self.p_para_nword[1])
                  for _ in range(nline)]
         nword = [max(1,int(np.ceil(n))) for n in nword]
 
         lines = self.get_lines(nline, nword, nchar_max, f=0.35)
         if lines is not None:
             # center align the paragraph-text:
-            if np.random.rand() < self.center_para:
+            if S.rand() < self.center_para:
                 lines = self.center_align(lines)
             return '\n'.join(lines)
         else:
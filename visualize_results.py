@@ -12,6 +12,7 @@ import numpy as np
 import matplotlib.pyplot as plt 
 import h5py 
 from common import *
+from image_store import read_image
 
 
 
@@ -54,7 +55,7 @@ def main(db_fname):
     dsets = sorted(db['data'].keys())
     print ("total number of images : ", colorize(Color.RED, len(dsets), bold=True))
     for k in dsets:
-        rgb = db['data'][k][...]
+        rgb = read_image(db['data'][k])
         charBB = db['data'][k].attrs['charBB']
         wordBB = db['data'][k].attrs['wordBB']
         txt = db['data'][k].attrs['txt']